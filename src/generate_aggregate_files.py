@@ -101,26 +101,45 @@ def clean_Twitter_csv_state(data_path, t_val):
     return data
 
 
-def generate_aggregate_misinformation (data_path, state_level):
+def read_aggregate_misinformation (aggregate_path):
+    # read as text, so that the reused rows are written back exactly as they were
+    return pd.read_csv(aggregate_path, index_col=0, dtype=str, keep_default_na=False)
+
+def generate_aggregate_misinformation (data_path, state_level, previous=None, since=None):
+    """
+    Aggregate the window tables in `data_path`, one t_val per window.
+        - With a `previous` aggregate (see `read_aggregate_misinformation`), the rows of the windows whose table
+        was not modified `since` that aggregate was written are reused instead of being computed again
+    """
 
     files = sorted(glob.glob(os.path.join(data_path,'*aggregated_table.csv')))
 
     data = None
 
     t_val = 0
+    reused = 0
     
     for fname in files:
         # ignore the last file
         if fname.find('2021-03-25_US_accounts_aggregated_table.csv') == -1:
-            if state_level:
-                df = clean_Twitter_csv_state(fname,t_val)
+            df = None
+            if previous is not None and os.path.getmtime(fname) <= since:
+                dates = os.path.basename(fname).split('_')
+                df = previous[(previous.start_day == dates[0]) & (previous.end_day == dates[1])].copy()
+                df['t_val'] = str(t_val)
+            if df is None or df.__len__() == 0:
+                if state_level:
+                    df = clean_Twitter_csv_state(fname,t_val)
+                else:
+                    df = clean_Twitter_csv(fname,t_val)
             else:
-                df = clean_Twitter_csv(fname,t_val)
+                reused += 1
             t_val += 1
             if data is None:
                 data = df
             else:
                 data = pd.concat([data,df])
+    print('Windows aggregated: '+str(t_val-reused)+', reused: '+str(reused))
     return data
 
 def get_stderr(num_accept,sample_size):
@@ -214,9 +233,13 @@ if __name__ == '__main__':
     if state_level:
         aggregate_misinfo_name = 'state_level_'+aggregate_misinfo_name
 
-    if not os.path.exists(os.path.join(misinfo_path,aggregate_misinfo_name)):
-        df_misinfo = generate_aggregate_misinformation (misinfo_path, state_level)
-        df_misinfo.to_csv(os.path.join(misinfo_path,aggregate_misinfo_name))
+    # only the windows written again by get_temporal_data.py since the last run are aggregated again
+    previous, since = None, None
+    if os.path.exists(os.path.join(misinfo_path,aggregate_misinfo_name)) and not args.force:
+        previous = read_aggregate_misinformation(os.path.join(misinfo_path,aggregate_misinfo_name))
+        since = os.path.getmtime(os.path.join(misinfo_path,aggregate_misinfo_name))
+    df_misinfo = generate_aggregate_misinformation (misinfo_path, state_level, previous, since)
+    df_misinfo.to_csv(os.path.join(misinfo_path,aggregate_misinfo_name))
 
     county_path = config["PATHS"]["COUNTY_DATA_DIR"]
     state_path = config["PATHS"]["STATE_DATA_DIR"]
@@ -1,58 +1,345 @@
-import pandas as pd
-import json
-import sys
-import glob as glob
-import gzip
+"""
+PURPOSE:
+    - This script aggregates the daily US accounts tables
+    (`{day}_US_accounts_table`, in TABLES_DAILY_FOLDER) over windows of
+    N days, writing one table per window in
+    TABLES_TEMPORAL_FOLDER/{N}day/.
+    - The daily tables are loaded once into sparse (account, state,
+    county) x day matrices of tweet and low-credibility tweet counts.
+    The counts of all windows of N days are then a single sparse
+    product with a day x window indicator matrix (a sum over a slice of
+    days for each window), so producing the tables of several window
+    sizes (TEMPORAL_WINDOWS in the config file, e.g. 1,3,7,14) costs
+    about the same as producing one.
+    - The daily counts are kept in a store (account_day_counts, in
+    TABLES_TEMPORAL_FOLDER) with a manifest of the daily tables it
+    contains and of the window files written from it. A run only reads
+    the daily tables that are new or changed, and only writes the
+    windows that contain one of these days.
+"""
 import os
-import configparser
-import tldextract
-from carmen import get_resolver
-from carmen.location import Location
-from collections import defaultdict
-import timeit
-import pickle as pkl
-import csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
-from utils import parse_cl_args, parse_config_file, Geo
-
-# Load config_file_path from commandline input
-args = parse_cl_args()
-config_file = args.config_file
-
-config = configparser.ConfigParser()
-# Read in parameters
-config.read(config_file)
-
-## Read daily files
-dates = pd.date_range("2021-01-04", "2021-03-25")
-dfs = []
-for day in dates:
-    day_string = day.strftime("%Y-%m-%d")
-    df = pd.read_csv(os.path.join(config["PATHS"]["TABLES_DAILY_FOLDER"],
-                           str(day_string) + "_US_accounts_table.csv"))
-    df["day"] = [day for i in range(df.__len__())]
-    dfs.append(df)
-dfs = pd.concat(dfs) # concatenating all daily results
-
-## Produce N-day results
-N = '1'
-if not os.path.exists(os.path.join(config["PATHS"]["TABLES_TEMPORAL_FOLDER"], N+"day")):
-  os.makedirs(os.path.join(config["PATHS"]["TABLES_TEMPORAL_FOLDER"], N+"day"))
- 
-## Resample dates and produce aggregated data
-for ix, df in dfs.resample(N+'D', on ="day"):
-    start_date = min(df["day"]).strftime("%Y-%m-%d")
-    end_date = max(df["day"]).strftime("%Y-%m-%d")
-    print(start_date + " to " + end_date)
-    ## now group by account and sum stats
-    final_df = df.groupby(["account_id", "state", "county"]).sum().reset_index()
-    final_df = final_df.reset_index()
-    final_df["fraction_misinfo"] = (final_df["no_low_cred_tweets"]/final_df["no_tweets"])
-
-    
-    final_df.to_csv(os.path.join(config["PATHS"]["TABLES_TEMPORAL_FOLDER"],
-                                        N+"day/"+start_date+"_"+end_date+"_US_accounts_aggregated_table.csv"), index=False)
-
-    
+import pandas as pd
+import scipy.sparse as sp
+
+from utils import parse_cl_args, parse_config_file, get_table_format, read_table, write_table, table_path
+from utils import load_manifest, save_manifest
+
+KEY_COLUMNS = ["account_id", "state", "county"]
+# Columns of the daily US accounts tables that are aggregated, and their types
+DAILY_DTYPES = {"account_id": "int64", "state": "category", "county": "category",
+                "no_tweets": "int64", "no_low_cred_tweets": "int64"}
+# Only empty fields are missing in csv tables: an unknown state or county is written as "None", and is kept as such
+NA_VALUES = [""]
+# Number of threads reading the daily tables
+LOAD_THREADS = 8
+# Store of the daily counts read so far (in TABLES_TEMPORAL_FOLDER), and manifest of its daily tables and window files
+STORE_TABLE = "account_day_counts.csv"
+STORE_MANIFEST = "account_day_counts_manifest.json"
+STORE_DTYPES = {"day": "category", **DAILY_DTYPES}
+
+
+def get_dates(config):
+    """Return the days of the study (START_DAY to END_DAY in the config file)."""
+    return pd.date_range(config["DATA"]["START_DAY"], config["DATA"]["END_DAY"])
+
+
+def get_windows(config):
+    """Return the window sizes (in days) set by TEMPORAL_WINDOWS in the config file (default: 1)."""
+    windows = config.get("DATA", "TEMPORAL_WINDOWS", fallback="1")
+    return [int(n) for n in windows.split(",") if n.strip()]
+
+
+def daily_table_path(config, day):
+    """Return the path of the US accounts table of `day`, in TABLES_DAILY_FOLDER."""
+    return table_path(os.path.join(config["PATHS"]["TABLES_DAILY_FOLDER"],
+                                   day.strftime("%Y-%m-%d") + "_US_accounts_table.csv"), get_table_format(config))
+
+
+def count_daily_rows(config, day):
+    """Return the number of rows of the US accounts table of `day` (without parsing it), or None if it does not exist."""
+    path = daily_table_path(config, day)
+    if not os.path.exists(path):
+        return None
+    if get_table_format(config) == "parquet":
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetFile(path).metadata.num_rows
+    with open(path, "rb") as f:
+        return sum(1 for line in f if line.strip()) - 1  # header
+
+
+def read_daily_table(config, day):
+    """Read the US accounts table of `day` with the dtypes of DAILY_DTYPES, or return None if it does not exist."""
+    path = daily_table_path(config, day)
+    if not os.path.exists(path):
+        return None
+    df = read_table(path, get_table_format(config), dtype=DAILY_DTYPES, columns=list(DAILY_DTYPES),
+                    na_values=NA_VALUES)
+    return df.astype(DAILY_DTYPES)
+
+
+def load_daily_tables(config, dates, threads=LOAD_THREADS):
+    """
+    Read the daily US accounts tables of `dates` in `threads` concurrent threads and return them as one dataframe,
+    with a categorical "day" column (one category per day that was read).
+        - Days without a daily table are reported and skipped
+        - The row counts of the tables are taken first, so that each table is copied into columns preallocated
+        for all rows as soon as it is read (and then released), instead of concatenating dataframes
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        n_rows = list(executor.map(lambda day: count_daily_rows(config, day), dates))
+
+        missing = [day.strftime("%Y-%m-%d") for day, n in zip(dates, n_rows) if n is None]
+        if missing:
+            print(f"No daily table for {missing.__len__()} day(s), skipping: " + ", ".join(missing))
+        days = pd.DatetimeIndex([day for day, n in zip(dates, n_rows) if n is not None])
+        n_rows = [n for n in n_rows if n is not None]
+        if not n_rows:
+            raise FileNotFoundError("No daily US accounts table in " + config["PATHS"]["TABLES_DAILY_FOLDER"])
+        offsets = np.concatenate([[0], np.cumsum(n_rows)])
+
+        ## Categories shared by all days: the codes of each table are mapped to the codes of these categories
+        categories = {"state": {}, "county": {}}
+        columns = {col: np.empty(offsets[-1], dtype=np.int32 if col in categories else dtype)
+                   for col, dtype in DAILY_DTYPES.items()}
+        day_codes = np.repeat(np.arange(days.__len__(), dtype=np.int32), n_rows)
+
+        futures = {executor.submit(read_daily_table, config, day): code for code, day in enumerate(days)}
+        for future in as_completed(futures):
+            code = futures.pop(future)
+            df = future.result()
+            if df.__len__() != n_rows[code]:
+                raise ValueError(f"Unexpected number of rows in the daily table of {days[code].strftime('%Y-%m-%d')}")
+            rows = slice(offsets[code], offsets[code + 1])
+            for col in DAILY_DTYPES:
+                if col in categories:
+                    # an empty (e.g. all missing) column has no categories, and all codes are -1
+                    lookup = np.array([categories[col].setdefault(value, categories[col].__len__())
+                                       for value in df[col].cat.categories] + [-1], dtype=np.int32)
+                    columns[col][rows] = lookup[df[col].cat.codes.values]
+                else:
+                    columns[col][rows] = df[col].values
+            del df
+
+    daily = pd.DataFrame({col: pd.Categorical.from_codes(columns[col], pd.Index(list(categories[col]), dtype=object))
+                          if col in categories else columns[col] for col in DAILY_DTYPES})
+    daily["day"] = pd.Categorical.from_codes(day_codes, days)
+    return daily
+
+
+class AccountDayCounts:
+    """
+    Tweet and low-credibility tweet counts of each (account_id, state, county) on each day, as sparse matrices with
+    one row per key of `keys` and one column per day of `days`.
+        - Rows with an unknown state or county are left out, as when grouping the daily tables by these columns
+        - `present` flags the days that have at least one row in the daily tables
+    """
+
+    def __init__(self, keys, days, tweets, low_cred, present):
+        self.keys = keys
+        self.days = days
+        self.tweets = tweets
+        self.low_cred = low_cred
+        self.present = present
+
+    @classmethod
+    def from_daily(cls, daily):
+        """Build the matrices from the daily tables returned by `load_daily_tables`."""
+        days = pd.DatetimeIndex(daily["day"].cat.categories)
+        present = np.bincount(daily["day"].cat.codes, minlength=days.__len__()) > 0
+
+        rows = daily.dropna(subset=KEY_COLUMNS)
+        row_keys = pd.MultiIndex.from_arrays([rows[col].astype(object).values for col in KEY_COLUMNS],
+                                             names=KEY_COLUMNS)
+        keys = row_keys.unique().sort_values()
+        row_ids = keys.get_indexer(row_keys)
+        day_ids = rows["day"].cat.codes.values
+        shape = (keys.__len__(), days.__len__())
+        tweets = sp.csr_matrix((rows["no_tweets"].values.astype(np.int64), (row_ids, day_ids)), shape=shape)
+        low_cred = sp.csr_matrix((rows["no_low_cred_tweets"].values.astype(np.int64), (row_ids, day_ids)), shape=shape)
+        return cls(keys.to_frame(index=False), days, tweets, low_cred, present)
+
+    def window_matrix(self, n_days, step=None):
+        """
+        Return the day x window indicator matrix of windows of `n_days` days starting every `step` days (default:
+        `n_days`, i.e. consecutive windows; a smaller step gives sliding windows), from the first day.
+        """
+        step = step or n_days
+        offsets = np.asarray((self.days - self.days[0]).days)
+        starts = np.arange(0, offsets.max() + 1, step)
+        day_ids, window_ids = [], []
+        for window, start in enumerate(starts):
+            in_window = np.flatnonzero((offsets >= start) & (offsets < start + n_days))
+            day_ids.append(in_window)
+            window_ids.append(np.full(in_window.__len__(), window))
+        day_ids, window_ids = np.concatenate(day_ids), np.concatenate(window_ids)
+        return sp.csc_matrix((np.ones(day_ids.__len__(), dtype=np.int64), (day_ids, window_ids)),
+                             shape=(self.days.__len__(), starts.__len__()))
+
+    def windows_containing(self, days, n_days, step=None):
+        """Return the ids of the windows of `n_days` days (see `window_matrix`) that contain one of `days`."""
+        step = step or n_days
+        windows = set()
+        for offset in np.asarray((pd.DatetimeIndex(days) - self.days[0]).days):
+            windows.update(range(max(0, -(-(offset - n_days + 1) // step)), offset // step + 1))
+        return windows
+
+    def aggregate(self, n_days, step=None, windows=None):
+        """
+        Yield the id, start day, end day and aggregated table of each window of `n_days` days (see `window_matrix`),
+        or only of the `windows` ids: one row per (account_id, state, county) with tweets in the window.
+        Windows without data are skipped.
+        """
+        window_matrix = self.window_matrix(n_days, step)
+        ids = np.arange(window_matrix.shape[1])
+        if windows is not None:
+            ids = ids[np.isin(ids, list(windows))]
+            window_matrix = window_matrix[:, ids]
+        tweets = (self.tweets @ window_matrix).tocsc()
+        low_cred = (self.low_cred @ window_matrix).tocsc()
+        tweets.sort_indices()
+
+        for window, window_id in enumerate(ids):
+            window_days = self.days[window_matrix[:, window].indices[self.present[window_matrix[:, window].indices]]]
+            if window_days.__len__() == 0:
+                continue
+            rows = tweets.indices[tweets.indptr[window]:tweets.indptr[window + 1]]
+            final_df = self.keys.iloc[rows].reset_index(drop=True)
+            final_df["no_tweets"] = tweets.data[tweets.indptr[window]:tweets.indptr[window + 1]]
+            final_df["no_low_cred_tweets"] = low_cred[:, window].toarray().ravel()[rows]
+            final_df = final_df.reset_index()
+            final_df["fraction_misinfo"] = (final_df["no_low_cred_tweets"]/final_df["no_tweets"])
+            yield window_id, min(window_days).strftime("%Y-%m-%d"), max(window_days).strftime("%Y-%m-%d"), final_df
+
+
+def update_store(config, dates, force=False, threads=LOAD_THREADS):
+    """
+    Update the store of daily counts (STORE_TABLE, in TABLES_TEMPORAL_FOLDER) with the daily tables of `dates`.
+        - Only the days whose daily table is new or changed (size or modification time) since the last run
+        (according to STORE_MANIFEST) are read, and the days whose table was removed (or that are out of `dates`)
+        are dropped; with `force` the store is rebuilt from all daily tables
+    Returns the store (as `load_daily_tables`), its manifest and the days that changed.
+    """
+    table_format = get_table_format(config)
+    os.makedirs(config["PATHS"]["TABLES_TEMPORAL_FOLDER"], exist_ok=True)
+    store_path = os.path.join(config["PATHS"]["TABLES_TEMPORAL_FOLDER"], STORE_TABLE)
+    manifest_path = os.path.join(config["PATHS"]["TABLES_TEMPORAL_FOLDER"], STORE_MANIFEST)
+    manifest = {} if force else load_manifest(manifest_path)
+    if not os.path.exists(table_path(store_path, table_format)):
+        manifest = {}
+    recorded = manifest.setdefault("days", {})
+
+    ## days recorded in the store but out of `dates` are removed as well
+    date_strings = set(dates.strftime("%Y-%m-%d"))
+    to_read, removed = [], [pd.Timestamp(day) for day in recorded if day not in date_strings]
+    for day in dates:
+        day_string = day.strftime("%Y-%m-%d")
+        path = daily_table_path(config, day)
+        if not os.path.exists(path):
+            if day_string in recorded:
+                removed.append(day)
+            continue
+        stat = os.stat(path)
+        entry = recorded.get(day_string)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            to_read.append(day)
+    changed = sorted(to_read + removed)
+    print("Daily tables to read: " + str(to_read.__len__()) + ", removed: " + str(removed.__len__()))
+
+    if recorded:
+        store = read_table(store_path, table_format, dtype=STORE_DTYPES, na_values=NA_VALUES)
+        store = store[~store["day"].astype(str).isin([day.strftime("%Y-%m-%d") for day in changed])]
+    else:
+        store = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in STORE_DTYPES.items()})
+    store = store.astype({"day": str})
+
+    if to_read:
+        stats = {day: os.stat(daily_table_path(config, day)) for day in to_read}  # taken before reading
+        new = load_daily_tables(config, to_read, threads)
+        new_days = new["day"].cat.categories
+        rows = np.bincount(new["day"].cat.codes, minlength=new_days.__len__())
+        new["day"] = new["day"].cat.rename_categories(new_days.strftime("%Y-%m-%d")).astype(str)
+        store = pd.concat([store, new[list(STORE_DTYPES)]], ignore_index=True)
+        for day, n_rows in zip(new_days, rows):
+            recorded[day.strftime("%Y-%m-%d")] = {"size": stats[day].st_size, "mtime": stats[day].st_mtime,
+                                                  "rows": int(n_rows)}
+    for day in removed:
+        del recorded[day.strftime("%Y-%m-%d")]
+
+    if changed:
+        store = store.sort_values("day", kind="stable").reset_index(drop=True)
+        write_table(store, store_path, table_format, categorical=["day", "state", "county"])
+        save_manifest(manifest, manifest_path)
+
+    ## the store as one dataframe with a categorical day, as returned by `load_daily_tables`
+    days = sorted(recorded)
+    store = store.astype({col: dtype for col, dtype in STORE_DTYPES.items() if col != "day"})
+    store["day"] = pd.Categorical(store["day"].astype(str), categories=days)
+    store["day"] = store["day"].cat.rename_categories(pd.DatetimeIndex(days))
+    return store, manifest, changed
+
+
+def write_window_tables(config, counts, n_days, manifest, changed=None, step=None):
+    """
+    Write the aggregated table of each window of `n_days` days in TABLES_TEMPORAL_FOLDER/{n_days}day/
+        - The files written are recorded in the "windows" entry of the store `manifest`, so that only the windows
+        containing one of the `changed` days (all of them if None) are written again. The file of a window whose
+        end day changed, or that no longer has data, is removed.
+    """
+    N = str(n_days)
+    out_dir = os.path.join(config["PATHS"]["TABLES_TEMPORAL_FOLDER"], N+"day")
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    ## a new first day shifts all windows
+    first_day = counts.days[0].strftime("%Y-%m-%d")
+    if manifest.get("first_day") != first_day:
+        manifest["first_day"] = first_day
+        for n, written in manifest.get("windows", {}).items():
+            for file in written.values():
+                if os.path.exists(os.path.join(config["PATHS"]["TABLES_TEMPORAL_FOLDER"], n+"day", file)):
+                    os.remove(os.path.join(config["PATHS"]["TABLES_TEMPORAL_FOLDER"], n+"day", file))
+            written.clear()
+    written = manifest.setdefault("windows", {}).setdefault(N, {})
+
+    n_windows = counts.window_matrix(n_days, step).shape[1]
+    missing = {int(window) for window, file in written.items()
+               if not os.path.exists(os.path.join(out_dir, file))}
+    if changed is None or not written:
+        windows = set(range(n_windows))
+    else:
+        windows = counts.windows_containing(changed, n_days, step) | missing
+    windows |= {int(window) for window in written if int(window) >= n_windows}
+
+    files = {}
+    for window, start_date, end_date, final_df in counts.aggregate(n_days, step, windows):
+        print(start_date + " to " + end_date)
+        files[window] = start_date+"_"+end_date+"_US_accounts_aggregated_table.csv"
+        final_df.to_csv(os.path.join(out_dir, files[window]), index=False)
+
+    for window in windows:
+        old_file = written.pop(str(window), None)
+        if old_file is not None and old_file != files.get(window) and os.path.exists(os.path.join(out_dir, old_file)):
+            os.remove(os.path.join(out_dir, old_file))
+        if window in files:
+            written[str(window)] = files[window]
+    print(N + "-day windows written: " + str(files.__len__()) + " out of " + str(n_windows))
+
+
+if __name__ == "__main__":
+    # Load config_file_path from commandline input
+    args = parse_cl_args()
+    config = parse_config_file(args.config_file)
+
+    ## Add the new (or changed) daily files to the store of daily counts
+    store, manifest, changed = update_store(config, get_dates(config), args.force)
+    if not manifest["days"]:
+        raise FileNotFoundError("No daily US accounts table in " + config["PATHS"]["TABLES_DAILY_FOLDER"])
+    counts = AccountDayCounts.from_daily(store)
+
+    ## Produce N-day results, for the windows with new data
+    for n_days in get_windows(config):
+        write_window_tables(config, counts, n_days, manifest, changed)
+    save_manifest(manifest, os.path.join(config["PATHS"]["TABLES_TEMPORAL_FOLDER"], STORE_MANIFEST))
@@ -0,0 +1,83 @@
+"""
+PURPOSE:
+    - This module contains the index of low-credibility sources (the
+    Iffy+/MBFC list in LOW_CRED_FILE), used to flag the links shared in
+    tweets.
+    - A host matches a list entry if it is the listed site or one of its
+    subdomains, so both registered domains (breitbart.com) and listed
+    subdomains (america.cgtn.com) are matched by the same lookup. The
+    most specific entry wins.
+    - The index is a dict keyed on the listed sites: a lookup checks the
+    suffixes of the host (one dict access per label), and rebuilding it
+    from a new list only takes a pass over the `site` column.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from tldextract.remote import lenient_netloc
+
+
+def _normalize_host(host):
+    return host.strip().lower().rstrip(".")
+
+
+class LowCredibilityIndex:
+    """Suffix index over the sites of a low-credibility list.
+        - `lookup(host)` returns the matched list entry (its `site`), or None
+        - `entry(site)` returns the full row of the list for that site
+    """
+
+    def __init__(self, sites, entries=None):
+        self.sites = {}
+        for ix, site in enumerate(sites):
+            if isinstance(site, str) and site.strip():
+                self.sites.setdefault(_normalize_host(site), ix)
+        self.entries = entries
+
+    @classmethod
+    def from_dataframe(cls, df, site_column="site"):
+        return cls(df[site_column].values, df.reset_index(drop=True))
+
+    @classmethod
+    def from_csv(cls, path, site_column="site"):
+        """Build the index from a list of sources such as low_credibility.csv"""
+        return cls.from_dataframe(pd.read_csv(path), site_column)
+
+    @classmethod
+    def from_config(cls, config):
+        """Build the index from LOW_CRED_FILE, in INTERMEDIATE_DATA_DIR."""
+        return cls.from_csv(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], config["FILES"]["LOW_CRED_FILE"]))
+
+    def __len__(self):
+        return self.sites.__len__()
+
+    def __contains__(self, host):
+        return self.lookup(host) is not None
+
+    def lookup(self, host):
+        """Return the list entry matching `host` (the host itself or its closest listed parent domain), or None."""
+        if not isinstance(host, str):
+            return None
+        host = _normalize_host(host)
+        while host:
+            if host in self.sites:
+                return host
+            host = host.partition(".")[2]
+        return None
+
+    def lookup_url(self, url):
+        """Return the list entry matching the host of `url`, or None."""
+        if not isinstance(url, str):
+            return None
+        return self.lookup(lenient_netloc(url))
+
+    def lookup_many(self, hosts):
+        """Return an array with the list entry matching each host (None where there is no match)."""
+        return np.array([self.lookup(host) for host in hosts], dtype=object)
+
+    def entry(self, site):
+        """Return the row of the list for a matched `site` (as a Series), or None."""
+        if self.entries is None or site not in self.sites:
+            return None
+        return self.entries.iloc[self.sites[site]]
@@ -52,7 +52,7 @@ import numpy as np
 import scipy.stats as stats
 
 # utils.py from this repo
-from utils import parse_cl_args, parse_config_file, Geo
+from utils import parse_cl_args, parse_config_file, Geo, get_table_format, read_table
 
 ### Create Functions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -536,9 +536,9 @@ def get_summary_stats(county_df):
         ]
     )
 
-def clean_Twitter_csv_state(data_path,just_state_identified_accounts = False):
+def clean_Twitter_csv_state(data_path,just_state_identified_accounts = False,table_format = "csv"):
     
-    twitter_data = pd.read_csv(data_path)
+    twitter_data = read_table(data_path,table_format)
     
     if just_state_identified_accounts:
         state_data = twitter_data[(df.county.isna()) | (df.county == 'None')].groupby('state').apply(lambda x: get_summary_stats(x))
@@ -576,9 +576,9 @@ def threshold_accounts(df, accounts_per_county, tweets_per_account, only_with_co
     
     return results
 
-def clean_Twitter_csv(data_path):
+def clean_Twitter_csv(data_path,table_format = "csv"):
 
-    twitter_data = pd.read_csv(data_path)
+    twitter_data = read_table(data_path,table_format)
 
     twitter_data = twitter_data.replace('St. Tammany Parish','St Tammany Parish')
     twitter_data = twitter_data.replace('St. Joseph County','St Joseph County')
@@ -764,10 +764,11 @@ if __name__ == '__main__':
     else:
         election_data = clean_Election_csv(election_file_path)
 
+    # The accounts table is a .csv or a .parquet file depending on INTERMEDIATE_FORMAT
     if state_level:
-        twitter_data = clean_Twitter_csv_state(twitter_data_file,False)
+        twitter_data = clean_Twitter_csv_state(twitter_data_file,False,get_table_format(config))
     else:
-        twitter_data = clean_Twitter_csv(twitter_data_file)
+        twitter_data = clean_Twitter_csv(twitter_data_file,get_table_format(config))
     
     all_data = [
         people_data,
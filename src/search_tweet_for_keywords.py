@@ -1,17 +1,20 @@
 from collections import Counter
 from urllib.parse import urlparse
-import json
 import urlexpander
-import gzip
 import os
 import pprint
 import pandas as pd
 import configparser
 import argparse
 import sys
-import glob
 
-from utils import parse_cl_args,parse_config_file
+from utils import parse_cl_args,parse_config_file,list_tweet_files,iter_tweet_lines,load_tweet
+
+# Optional C implementation of the Aho-Corasick automaton
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 
 # This function traverses a dictionary hierarchy (dicts within dicts)
@@ -33,8 +36,59 @@ def get_expanded_urls (twitter_urls_list):
     else:
         return [u['expanded_url'] for u in twitter_urls_list]
 
+class KeywordMatcher:
+    """ Keywords compiled once to be matched against many texts.
+
+    A keyword matches a text when all of its individual (space separated) words are
+    substrings of the text. The distinct words of all keywords are searched for in a
+    single pass over the text (with an Aho-Corasick automaton when `pyahocorasick` is
+    installed), then combined with AND for each keyword.
+    """
+
+    def __init__ (self, keywords):
+        self.keywords = set(keywords)
+        self.keyword_words = {keyword: frozenset(keyword.split(' ')) for keyword in self.keywords}
+        words = set().union(*self.keyword_words.values())
+
+        # The empty word is in every text
+        self.always_found = {w for w in words if w == ''}
+        words = words - self.always_found
+
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for word in words:
+                self.automaton.add_word(word, word)
+            self.automaton.make_automaton()
+        else:
+            self.automaton = None
+            # Longest words first: when a word is found, all the words it contains are found too
+            self.words = sorted(words, key=lambda w: (-len(w), w))
+            self.contained_words = {w: {v for v in words if v in w} for w in words}
+
+    def find_words (self, lower_text):
+        """ Returns the set of individual keyword words present in the text """
+        found = set(self.always_found)
+        if self.automaton is not None:
+            for _, word in self.automaton.iter(lower_text):
+                found.add(word)
+        else:
+            for word in self.words:
+                if word not in found and word in lower_text:
+                    found |= self.contained_words[word]
+        return found
+
+    def match (self, lower_text):
+        """ Returns the set of keywords matching the text """
+        found = self.find_words(lower_text)
+        return {keyword for keyword, words in self.keyword_words.items() if words <= found}
+
+
 def search_tweet_for_keywords (tweet_json, keywords_set):
-    """ Takes the json of a tweet and searchs it for terms in the keywords list """
+    """ Takes the json of a tweet and searchs it for terms in the keywords list
+    (`keywords_set` is best passed as a KeywordMatcher, compiled once for all tweets) """
+
+    if not isinstance(keywords_set, KeywordMatcher):
+        keywords_set = KeywordMatcher(keywords_set)
 
     # Extract text from the four different relevant places it could be
     text = get_dict_path(tweet_json, ['text',])
@@ -75,18 +129,8 @@ def search_tweet_for_keywords (tweet_json, keywords_set):
         text += ' ' + ' '.join([u for u in get_expanded_urls(get_dict_path(tweet_json, ['quoted_status','extended_tweet','entities','urls']))])
 
         lower_text = text.lower()
-        for keyword in keywords_set:
-            # All individual words must be present for this keyword to
-            # match. We start by assuming the keyword is present.
-            keyword_present = True
-            for ind_kword in keyword.split(' '):
-                if lower_text.find (ind_kword) == -1:
-                    # If an individual word isn't present, stop
-                    # matching
-                    keyword_present = False
-                    break
-            if keyword_present:
-                keywords_found.add(keyword)
+        # All individual words of a keyword must be present for it to match
+        keywords_found = keywords_set.match(lower_text)
             
     #    print (text)
     #    print (keywords_found)
@@ -108,15 +152,14 @@ def generate_tweet_id_keyword_map (tweet_path, output_path, keywords):
         
     output = list()
     counter = 0
-    with gzip.open(tweet_path,'r') as f:
-        for raw_tweet in f:
-            j = json.loads(raw_tweet)
-            tid = get_dict_path(j,['id'])
-            found_keywords = search_tweet_for_keywords(j,keywords)
-            for keyword in found_keywords:
-                output += ((tid,keyword),)
+    for raw_tweet in iter_tweet_lines(tweet_path):
+        j = load_tweet(raw_tweet)
+        tid = get_dict_path(j,['id'])
+        found_keywords = search_tweet_for_keywords(j,keywords)
+        for keyword in found_keywords:
+            output += ((tid,keyword),)
 
-            counter += 1
+        counter += 1
 
                 
     df_out = pd.DataFrame (output,columns=['tweet_id','keyword'])
@@ -126,11 +169,11 @@ def generate_tweet_id_keyword_map (tweet_path, output_path, keywords):
 
 def generate_tweet_keyword_maps(config, keywords):
     tables_folder = config["PATHS"]["TABLES_DAILY_FOLDER"]
-    input_files=glob.glob(config['PATHS']['STREAMING_FILES_FOLDER']+'/*gz')
+    input_files=list_tweet_files(config['PATHS']['STREAMING_FILES_FOLDER'])
 
     num_tweets_processed = 0
     for in_file in input_files:
-        day = in_file.replace(config["PATHS"]["STREAMING_FILES_FOLDER"] + "/streaming_data--", "").replace(".json.gz", "")  
+        day = os.path.basename(in_file).replace("streaming_data--", "").split(".json")[0]
         output_file = os.path.join(config["PATHS"]["TABLES_DAILY_FOLDER"], str(day) + "_tweet_keywords_full_table.csv")
         if os.path.exists (output_file):
             print ("Already processed", output_file)
@@ -143,7 +186,7 @@ if __name__ == '__main__':
     config_file_path = parse_cl_args()
     config = parse_config_file(config_file_path)
 
-    keywords = load_keywords_file ('keywords.txt')
+    keywords = KeywordMatcher(load_keywords_file ('keywords.txt'))
 
     generate_tweet_keyword_maps(config,keywords)
 
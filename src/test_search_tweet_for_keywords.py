@@ -0,0 +1,100 @@
+"""
+Tests of the keyword matching (search_tweet_for_keywords.py): KeywordMatcher must find exactly the keywords found by
+the original per-keyword, per-word `str.find` loop, with and without pyahocorasick.
+Run from the src folder with `python -m pytest`.
+"""
+import os
+import random
+
+import pytest
+
+import search_tweet_for_keywords
+from search_tweet_for_keywords import KeywordMatcher, load_keywords_file, search_tweet_for_keywords as search
+
+KEYWORDS = load_keywords_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "keywords.txt"))
+# keywords that are substrings of others, share words, repeat a word, or are empty
+EXTRA_KEYWORDS = {"covid", "covid-19", "covid 19", "vax vaxx", "pfizer pfizer", "rna mrna", "corona virus", ""}
+
+TEXTS = [
+    "",
+    "covid",
+    "covid-19",
+    "covid19 is not covid-19",
+    "covid_19 pfizer",
+    "pfizer and biontech, covid-19 vaccine",
+    "get vaxxed! #vaxxx",
+    "the vax debate",
+    "vaxx",
+    "mrna vaccines",
+    "rna",
+    "coronavirusupdates: moderna",
+    "coronavirus moderna astrazeneca biontech pfizer",
+    "corona pfizer",
+    "#greatreset #iwillnotcomply #endthelockdown",
+    "sputnikv https://example.com/covidvaccine",
+    "cepi gavi covax",
+    "no keyword at all",
+    "notocoronavirusvaccines",
+    "vaccinessavelives vaccineworks thisisourshot",
+]
+
+
+def make_corpus(n_texts=2000, seed=0):
+    """Fixed random texts made of keyword words, parts of them and other words."""
+    rng = random.Random(seed)
+    words = sorted({word for keyword in KEYWORDS | EXTRA_KEYWORDS for word in keyword.split(" ") if word})
+    pieces = words + [word[:rng.randint(1, len(word))] for word in words] + ["the", "and", "#", "-", "_", "19"]
+    corpus = list(TEXTS)
+    for _ in range(n_texts):
+        corpus.append(rng.choice(["", " "]).join(rng.choice(pieces) for _ in range(rng.randint(0, 12))))
+    return corpus
+
+
+def reference_match(lower_text, keywords):
+    """The original matching loop of search_tweet_for_keywords."""
+    keywords_found = set()
+    for keyword in keywords:
+        keyword_present = True
+        for ind_kword in keyword.split(' '):
+            if lower_text.find(ind_kword) == -1:
+                keyword_present = False
+                break
+        if keyword_present:
+            keywords_found.add(keyword)
+    return keywords_found
+
+
+@pytest.fixture(params=["ahocorasick", "fallback"])
+def backend(request, monkeypatch):
+    if request.param == "ahocorasick":
+        pytest.importorskip("ahocorasick")
+    else:
+        monkeypatch.setattr(search_tweet_for_keywords, "ahocorasick", None)
+    return request.param
+
+
+@pytest.mark.parametrize("keywords", [KEYWORDS, KEYWORDS | EXTRA_KEYWORDS], ids=["keywords.txt", "extra"])
+def test_matcher_matches_reference(backend, keywords):
+    matcher = KeywordMatcher(keywords)
+    assert (matcher.automaton is None) == (backend == "fallback")
+    for text in make_corpus():
+        lower_text = text.lower()
+        assert matcher.match(lower_text) == reference_match(lower_text, keywords), text
+
+
+def test_search_tweet_for_keywords(backend):
+    matcher = KeywordMatcher(KEYWORDS)
+    tweet = {
+        "text": "RT @someone: Covid-19 ...",
+        "retweeted_status": {
+            "text": "Covid-19 ...",
+            "extended_tweet": {"full_text": "Covid-19 update from Pfizer",
+                               "entities": {"urls": [{"expanded_url": "https://example.com/mrna"}]}},
+        },
+        "quoted_status": {"text": "#vaxx"},
+        "entities": {"urls": [{"expanded_url": "https://example.com/greatreset"}]},
+    }
+    lower_text = "covid-19 update from pfizer #vaxx https://example.com/greatreset https://example.com/mrna"
+    assert search(tweet, matcher) == reference_match(lower_text, KEYWORDS)
+    assert search(tweet, KEYWORDS) == search(tweet, matcher)  # a plain set is compiled on the fly
+    assert search({"id": 1}, matcher) == set()
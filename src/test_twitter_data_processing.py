@@ -0,0 +1,195 @@
+"""
+Tests of the tweet tables built from the Twitter data files (twitter_data_processing.py): duplicate tweets
+replayed by the stream, within and across files, the parallel and resumed runs of `build_tables`, and the
+dump/load round trip of the partial tables. Run from the src folder with `python -m pytest`.
+"""
+import configparser
+import gzip
+import json
+import os
+import re
+import shutil
+
+import pytest
+
+from twitter_data_processing import MANIFEST_FILE, TweetTables, build_tables
+from utils import load_manifest
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+LOCATIONS = ["Seattle, WA", "London", "Austin, Texas", None, "somewhere"]
+TEXTS = ["Get your covid vaccine now", "pfizervaccine and covid moderna", "nothing here", "vaccination day"]
+
+# tweet ids of each data file: 3 is replayed within the first file, 8 within the second, 11 within the third,
+# and 2, 5 (first file) and 9 (second file) are replayed across files
+FILES = {
+    "streaming_data--2021-01-04.json": [1, 2, 3, 4, 5, 6, 3],
+    "streaming_data--2021-01-05.json.gz": [7, 2, 8, 9, 8, 10, 5],
+    "streaming_data--2021-01-06.json": [11, 9, 12, 11],
+}
+N_TWEETS = 12
+DUPLICATES_WITHIN_FILES, DUPLICATES_ACROSS_FILES = 3, 3
+
+
+def make_tweet(tweet_id, replay=False):
+    """A tweet of the stream; a replay has no keywords, no URLs and another location, so that keeping it besides
+    the first occurrence shows in the tables."""
+    urls = [] if replay else ["https://example.com/story%d" % tweet_id, "https://twitter.com/i/web/status/%d" % tweet_id]
+    if not replay and tweet_id % 3 == 0:
+        urls.append("https://news.example.org/shared")
+    return {
+        "id_str": str(tweet_id), "id": tweet_id,
+        "created_at": "Mon Jan %02d 10:00:00 +0000 2021" % (4 + tweet_id % 3),
+        "text": "nothing here" if replay else TEXTS[tweet_id % TEXTS.__len__()],
+        "user": {"id_str": str(100 + tweet_id % 5), "location": "replayed" if replay else LOCATIONS[tweet_id % LOCATIONS.__len__()],
+                 "screen_name": "u%d" % tweet_id},
+        "entities": {"urls": [{"url": "https://t.co/x", "expanded_url": url} for url in urls]},
+    }
+
+
+def write_tweet_file(folder, name, seen):
+    lines = []
+    for tweet_id in FILES[name]:
+        lines.append(json.dumps(make_tweet(tweet_id, replay=tweet_id in seen)) + "\n")
+        seen.add(tweet_id)
+    data = "".join(lines).encode()
+    if name.endswith(".gz"):
+        data = gzip.compress(data)
+    with open(os.path.join(folder, name), "wb") as f:
+        f.write(data)
+
+
+def make_config(tmp_path, name, table_format, files=FILES):
+    """Config with its own output folder, reading the data files `files` (written once in tmp_path/tw)."""
+    tw_folder = tmp_path / "tw"
+    if not tw_folder.exists():
+        tw_folder.mkdir()
+        seen = set()
+        for file in FILES:
+            write_tweet_file(tw_folder, file, seen)
+    folder = tmp_path / ("tw_" + name)
+    folder.mkdir()
+    for file in files:
+        shutil.copy2(tw_folder / file, folder / file)
+    config = configparser.ConfigParser()
+    config["DATA"] = {"INTERMEDIATE_FORMAT": table_format}
+    config["PATHS"] = {"TW_FILES_FOLDER": str(folder), "INTERMEDIATE_DATA_DIR": str(tmp_path / name)}
+    os.makedirs(config["PATHS"]["INTERMEDIATE_DATA_DIR"])
+    return config
+
+
+def output_files(config, table_format, folder=""):
+    """Contents (bytes) of the tables written by build_tables (in `folder` of INTERMEDIATE_DATA_DIR)."""
+    out_dir = os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], folder)
+    contents = {}
+    for table in TweetTables.table_files(table_format):
+        with open(os.path.join(out_dir, table), "rb") as f:
+            contents[table] = f.read()
+    return contents
+
+
+def duplicates_dropped(output):
+    match = re.search(r"Duplicate tweets dropped: (\d+) within files, (\d+) across files", output)
+    return int(match.group(1)), int(match.group(2))
+
+
+@pytest.fixture(scope="module", autouse=True)
+def in_src_dir():
+    """The workers read keywords.txt from the working directory."""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(SRC_DIR)
+        yield
+
+
+@pytest.fixture(scope="module", params=["csv", "parquet"])
+def serial_run(request, tmp_path_factory):
+    """A serial run of build_tables in each format (loading carmen takes a few seconds), and its config."""
+    table_format = request.param
+    if table_format == "parquet":
+        pytest.importorskip("pyarrow")
+    config = make_config(tmp_path_factory.mktemp("serial"), "serial", table_format)
+    build_tables(config)
+    return config, table_format
+
+
+def test_duplicates_dropped(serial_run):
+    config, table_format = serial_run
+    manifest = load_manifest(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], MANIFEST_FILE))
+    assert [manifest[file]["duplicates"] for file in FILES] == [1, 1, 1]
+
+    tables = TweetTables.load(config["PATHS"]["INTERMEDIATE_DATA_DIR"], table_format)
+    ids, accounts = tables.rows("account")
+    first_seen = list(dict.fromkeys(tweet_id for file in FILES for tweet_id in FILES[file]))
+    assert ids.tolist() == first_seen and tables.__len__() == N_TWEETS
+    assert accounts.tolist() == [100 + tweet_id % 5 for tweet_id in first_seen]
+    ids, locations = tables.rows("location")
+    assert "replayed" not in [tables.pools["location"].values[code] for code in locations]
+    ## the first occurrences are kept: every tweet has its URLs (but twitter.com ones) and keywords
+    ids, urls = tables.rows("url")
+    urls = [tables.pools["url"].values[code] for code in urls]
+    assert sorted(set(ids.tolist())) == list(range(1, N_TWEETS + 1))
+    assert not any("twitter.com" in url for url in urls)
+    assert urls.count("https://news.example.org/shared") == N_TWEETS // 3
+    ids, keywords = tables.rows("keyword")
+    assert set(ids.tolist()) == {tweet_id for tweet_id in first_seen if tweet_id % TEXTS.__len__() != 2}
+
+
+@pytest.mark.parametrize("workers", [2, 3])
+def test_parallel_run_matches_serial(tmp_path, serial_run, workers, capsys):
+    """The tables of a parallel run, and the partial tables of each file, are byte-identical to a serial run."""
+    serial, table_format = serial_run
+    parallel = make_config(tmp_path, "parallel", table_format)
+    build_tables(parallel, workers=workers)
+    assert duplicates_dropped(capsys.readouterr().out) == (DUPLICATES_WITHIN_FILES, DUPLICATES_ACROSS_FILES)
+    assert output_files(parallel, table_format) == output_files(serial, table_format)
+    for file in FILES:
+        assert output_files(parallel, table_format, os.path.join("partial_tables", file)) == \
+            output_files(serial, table_format, os.path.join("partial_tables", file)), file
+
+
+def test_resumed_run_matches_full_run(tmp_path, serial_run, capsys):
+    full, table_format = serial_run
+    ## a first run sees the first two files only, the resumed run only processes the third one
+    files = list(FILES)
+    resumed = make_config(tmp_path, "resumed", table_format, files[:2])
+    build_tables(resumed)
+    shutil.copy2(tmp_path / "tw" / files[2], os.path.join(resumed["PATHS"]["TW_FILES_FOLDER"], files[2]))
+    capsys.readouterr()
+    build_tables(resumed, workers=2)
+    output = capsys.readouterr().out
+    assert "Files to process: 1 out of 3" in output
+    assert duplicates_dropped(output) == (DUPLICATES_WITHIN_FILES, DUPLICATES_ACROSS_FILES)
+    assert output_files(resumed, table_format) == output_files(full, table_format)
+
+    build_tables(resumed)
+    assert "Files to process: 0 out of 3" in capsys.readouterr().out
+    assert output_files(resumed, table_format) == output_files(full, table_format)
+
+
+@pytest.mark.parametrize("table_format", ["csv", "parquet"])
+def test_dump_load_round_trip(tmp_path, table_format):
+    if table_format == "parquet":
+        pytest.importorskip("pyarrow")
+    tables = TweetTables()
+    seen = set()
+    for tweet_id in [tweet_id for file in FILES for tweet_id in FILES[file]]:
+        tweet = make_tweet(tweet_id, replay=tweet_id in seen)
+        seen.add(tweet_id)
+        urls = [url["expanded_url"] for url in tweet["entities"]["urls"]]
+        carmen = (tweet_id, "United States", "Texas", None, None) if tweet_id % 2 else (None,) * 5
+        tables.add_tweet(tweet_id, int(tweet["user"]["id_str"]), str(tweet["user"]["location"]), carmen,
+                         "2021-01-0%d" % (4 + tweet_id % 3), urls, sorted(tweet["text"].split(" ")))
+    assert tables.drop_duplicates() == DUPLICATES_WITHIN_FILES + DUPLICATES_ACROSS_FILES
+
+    tables.dump(str(tmp_path), table_format)
+    loaded = TweetTables.load(str(tmp_path), table_format)
+    for name in TweetTables.NAMES:
+        ids, values = tables.rows(name)
+        loaded_ids, loaded_values = loaded.rows(name)
+        assert loaded_ids.tolist() == ids.tolist(), name
+        if name in TweetTables.ID_NAMES:
+            assert loaded_values.tolist() == values.tolist()
+        else:
+            ## codes differ between the pools, the objects linked to each tweet do not
+            strings = tables.pools[name].values
+            loaded_strings = loaded.pools[name].values
+            assert [loaded_strings[code] for code in loaded_values] == [strings[code] for code in values], name
@@ -0,0 +1,259 @@
+"""
+Tests of the asynchronous URL expansion (url_expander.py), against a local stand-in for URL shorteners
+(an aiohttp server on 127.0.0.1). Run from the src folder with `python -m pytest`.
+"""
+import asyncio
+import socket
+import threading
+from collections import Counter
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import url_expander
+from url_expander import expand_urls_async, is_expanded
+
+PUBLISHER = "http://publisher.example/"
+RUN_TIMEOUT = 20  # seconds, a scheduler that runs longer than this is stuck
+SETTINGS = dict(max_connections=20, max_per_host=5, timeout=1, rate_per_host=1000, max_retries=3, backoff=0.01,
+                breaker_failures=5, breaker_cooldown=0.2, breaker_max_trips=2)
+
+
+def make_app(requests):
+    """Stand-in shortener: every request is counted in `requests`, by path prefix and by host."""
+
+    async def redirect(request):
+        # /r/<n>/<name>: n more hops on this shortener, then the publisher
+        n, name = int(request.match_info["n"]), request.match_info["name"]
+        location = PUBLISHER + name if n == 0 else "/r/%d/%s" % (n - 1, name)
+        raise web.HTTPMovedPermanently(location)
+
+    async def redirect_final(request):
+        # /f/<n>/<name>: n hops, then a page of this server (followed with REDIRECTS=final)
+        n, name = int(request.match_info["n"]), request.match_info["name"]
+        raise web.HTTPFound("/page/" + name if n == 0 else "/f/%d/%s" % (n - 1, name))
+
+    async def page(request):
+        return web.Response()
+
+    async def slow(request):
+        await asyncio.sleep(5)
+        return web.Response()
+
+    async def flaky(request):
+        # /flaky/<k>/<name>: throttled (429) for the first k requests of this path
+        tries = requests[request.path]
+        if tries <= int(request.match_info["k"]):
+            raise web.HTTPTooManyRequests()
+        raise web.HTTPMovedPermanently(PUBLISHER + request.match_info["name"])
+
+    async def recover(request):
+        # /recover/<k>/<name>: unavailable (503) for the first k requests of all /recover/ paths
+        if requests["recover"] <= int(request.match_info["k"]):
+            raise web.HTTPServiceUnavailable()
+        raise web.HTTPMovedPermanently(PUBLISHER + request.match_info["name"])
+
+    async def down(request):
+        raise web.HTTPServiceUnavailable()
+
+    async def via(request):
+        # /via/<host>/<name>: a redirect to /down/<name> on another host (a shortener behind a shortener)
+        port = request.url.port
+        raise web.HTTPFound("http://%s:%d/down/%s" % (request.match_info["host"], port, request.match_info["name"]))
+
+    @web.middleware
+    async def count(request, handler):
+        requests[request.path] += 1
+        requests[request.path.split("/")[1]] += 1
+        requests[request.host.split(":")[0]] += 1
+        return await handler(request)
+
+    app = web.Application(middlewares=[count])
+    app.router.add_route("HEAD", "/r/{n}/{name}", redirect)
+    app.router.add_route("HEAD", "/f/{n}/{name}", redirect_final)
+    app.router.add_route("HEAD", "/page/{name}", page)
+    app.router.add_route("HEAD", "/slow/{name}", slow)
+    app.router.add_route("HEAD", "/flaky/{k}/{name}", flaky)
+    app.router.add_route("HEAD", "/recover/{k}/{name}", recover)
+    app.router.add_route("HEAD", "/down/{name}", down)
+    app.router.add_route("HEAD", "/via/{host}/{name}", via)
+    return app
+
+
+@pytest.fixture(scope="module")
+def server():
+    """Run the stand-in shortener in a thread (with its own event loop) and yield its port and request counts."""
+    requests = Counter()
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(make_app(requests))
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield port, requests
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+
+@pytest.fixture(autouse=True)
+def local_shorteners(monkeypatch, server):
+    """The hosts of the stand-in server are short link services, the publisher is not."""
+    monkeypatch.setattr(url_expander, "SHORT_LINK_SERVICES", ["127.0.0.1", "localhost"])
+    server[1].clear()
+
+
+def expand(urls, **settings):
+    stats = {}
+    results = expand_urls_async(urls, stats=stats, **{**SETTINGS, **settings})
+    assert sorted(r[0] for r in results) == sorted(urls)
+    return {r[0]: r[1:] for r in results}, stats
+
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.parametrize("n_hops", [0, 1, 2, 3])
+def test_redirect_chain_domain(server, n_hops):
+    port, requests = server
+    url = "http://127.0.0.1:%d/r/%d/story%d" % (port, n_hops, n_hops)
+    results, stats = expand([url])
+    expanded, status, hops = results[url]
+    assert (expanded, status) == (PUBLISHER + "story%d/" % n_hops, "301")
+    assert hops.__len__() == n_hops + 2
+    assert requests["r"] == n_hops + 1  # the publisher itself is not requested
+    assert stats == {"retried": 0, "parked": 0, "failed": 0}
+
+
+@pytest.mark.parametrize("n_hops", [0, 1, 2, 3])
+def test_redirect_chain_final(server, n_hops):
+    port, requests = server
+    url = "http://127.0.0.1:%d/f/%d/page%d" % (port, n_hops, n_hops)
+    results, stats = expand([url], redirects="final")
+    expanded, status, hops = results[url]
+    assert (expanded, status) == ("http://127.0.0.1:%d/page/page%d/" % (port, n_hops), "200")
+    assert hops.__len__() == n_hops + 2
+
+
+def test_not_a_redirect(server):
+    port, requests = server
+    url = "http://127.0.0.1:%d/page/home" % port
+    results, stats = expand([url])
+    assert results[url] == (url + "/", "200", [url])
+
+
+def test_slow_endpoint_times_out(server):
+    port, requests = server
+    url = "http://127.0.0.1:%d/slow/x" % port
+    results, stats = expand([url], timeout=0.2, max_retries=1)
+    expanded, status, hops = results[url]
+    assert expanded == url and status == "TimeoutError" and not is_expanded(status)
+    assert requests["slow"] == 2  # retried once
+    assert stats == {"retried": 1, "parked": 0, "failed": 1}
+
+
+def test_connection_refused():
+    url = "http://127.0.0.1:%d/r/0/x" % closed_port()
+    results, stats = expand([url], max_retries=0)
+    expanded, status, hops = results[url]
+    assert expanded == url and status == "ClientConnectorError" and not is_expanded(status)
+    assert stats["failed"] == 1
+
+
+## Throttled and failing hosts: retries with backoff and circuit breakers
+
+def test_throttled_requests_are_retried(server):
+    port, requests = server
+    urls = ["http://127.0.0.1:%d/flaky/%d/u%d" % (port, i % 3, i) for i in range(30)]
+    results, stats = expand(urls, breaker_failures=100)
+    assert all(status == "301" for expanded, status, hops in results.values())
+    assert stats == {"retried": 20, "parked": 0, "failed": 0}
+    assert requests["flaky"] == 30 + 10 * 1 + 10 * 2
+
+
+def test_throttled_too_long(server):
+    port, requests = server
+    urls = ["http://127.0.0.1:%d/flaky/9/v%d" % (port, i) for i in range(3)]
+    results, stats = expand(urls, breaker_failures=100, max_retries=2)
+    assert all(status == "429" for expanded, status, hops in results.values())
+    assert requests["flaky"] == 3 * 3  # first try and two retries
+    assert stats == {"retried": 3, "parked": 0, "failed": 3}
+
+
+def test_host_recovers(server):
+    port, requests = server
+    # all the first requests fail, and so do the probes of the first three cooldowns
+    urls = ["http://127.0.0.1:%d/recover/23/w%d" % (port, i) for i in range(20)]
+    results, stats = expand(urls, max_retries=10, breaker_cooldown=0.05, breaker_max_trips=5)
+    assert all(status == "301" for expanded, status, hops in results.values())
+    assert stats["parked"] > 0 and stats["failed"] == 0
+    assert requests["recover"] == 23 + 20
+
+
+def test_host_stays_down(server):
+    port, requests = server
+    down = ["http://localhost:%d/down/d%d" % (port, i) for i in range(50)]
+    healthy = ["http://127.0.0.1:%d/r/1/h%d" % (port, i) for i in range(20)]
+    results, stats = expand(down + healthy, max_retries=10, breaker_max_trips=1)
+    assert all(results[url][1] in ("503", "CircuitOpen") for url in down)
+    assert all(results[url][1] == "301" for url in healthy)
+    assert stats["failed"] == 50
+    # the host is given up after two trips: far fewer requests than 50 URLs x 11 tries
+    assert requests["localhost"] < 50
+
+
+def _run_scheduler(urls, setup=None, **settings):
+    """Run an ExpansionScheduler directly, to inspect its circuit breakers (`setup(scheduler)` is called first)."""
+    settings = {**SETTINGS, **settings}
+    max_connections = settings.pop("max_connections")
+    timeout = settings.pop("timeout")
+
+    async def run():
+        connector = aiohttp.TCPConnector(limit=max_connections)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+            scheduler = url_expander.ExpansionScheduler(session, redirects="domain", **settings)
+            if setup is not None:
+                setup(scheduler)
+            results = await asyncio.wait_for(scheduler.run(urls, max_connections), RUN_TIMEOUT)
+        return scheduler, {r[0]: r[1:] for r in results}
+
+    return asyncio.run(run())
+
+
+def test_failing_hop_is_parked(server):
+    """A shortener behind a healthy one (127.0.0.1 -> localhost) is parked, not the healthy one."""
+    port, requests = server
+    chained = ["http://127.0.0.1:%d/via/localhost/c%d" % (port, i) for i in range(30)]
+    healthy = ["http://127.0.0.1:%d/r/0/h%d" % (port, i) for i in range(20)]
+    scheduler, results = _run_scheduler(chained + healthy, max_retries=10, breaker_max_trips=1)
+    assert scheduler.breakers["localhost"].given_up
+    assert scheduler.breakers["127.0.0.1"].trips == 0 and scheduler.breakers["127.0.0.1"].state == "closed"
+    assert all(results[url][1] in ("503", "CircuitOpen") for url in chained)
+    assert all(results[url][1] == "301" for url in healthy)
+    assert requests["localhost"] < 30
+
+
+def test_probe_reaching_a_parked_hop(server):
+    """The probe of a half-open host (127.0.0.1) succeeds but redirects to a parked host (localhost): the probe
+    closes the first breaker, so the URLs parked on it are released and the run finishes."""
+    port, requests = server
+    urls = ["http://127.0.0.1:%d/via/localhost/p%d" % (port, i) for i in range(10)]
+
+    def setup(scheduler):
+        first, second = scheduler.breakers["127.0.0.1"], scheduler.breakers["localhost"]
+        first.state, first.trips = "half-open", 1
+        second.state, second.trips = "open", 1
+        asyncio.get_running_loop().call_later(second.cooldown_time(), scheduler._half_open, "localhost")
+
+    scheduler, results = _run_scheduler(urls, setup, max_retries=10, breaker_failures=2, breaker_cooldown=0.1,
+                                        breaker_max_trips=2)
+    assert scheduler.breakers["127.0.0.1"].state == "closed" and not scheduler.breakers["127.0.0.1"].parked
+    assert scheduler.breakers["localhost"].given_up
+    assert all(results[url][1] in ("503", "CircuitOpen") for url in urls)
@@ -1,27 +1,70 @@
-import json
 import gzip
+import hashlib
 from carmen import get_resolver
-from carmen.location import Location
-from collections import defaultdict
+from collections import OrderedDict
+from functools import lru_cache
 import timeit
 import csv
-from utils import parse_cl_args, parse_config_file
-from search_tweet_for_keywords import load_keywords_file, search_tweet_for_keywords
+from array import array
+import numpy as np
+from utils import parse_cl_args, parse_config_file, list_tweet_files, iter_tweet_lines, load_tweet, created_at_day
+from utils import get_table_format, read_table, write_table, load_manifest, save_manifest
+from search_tweet_for_keywords import load_keywords_file, search_tweet_for_keywords, KeywordMatcher
+from low_credibility import LowCredibilityIndex
+from url_expander import expand_urls_async, get_expansion_settings, ExpansionCache, EXPANSION_CACHE_FILE, \
+    SHORT_LINK_SERVICES, is_retryable
 import pandas as pd
 import sys
 import tldextract
-import requests
+from tldextract.remote import lenient_netloc
 import concurrent.futures
-import queue
-import glob
 import os
-import pickle as pkl
 import urlexpander
 
 DEFAULT_START_DATE = "2021-01-04"
 DEFAULT_END_DATE = "2021-03-25"
 KEYWORDS = ["vaccine", "vaccination", "vaccinate", "vax"]
 
+## types of id columns, used when intermediate tables are read from .csv files (.parquet files keep their types)
+ID_DTYPES = {"tweet_id": "int64", "account": "int64", "account_id": "int64", "carmen_id": "Int64"}
+
+
+def read_intermediate_table(config, name, columns=None):
+    """ Function to read the intermediate table `name` (e.g. "tweet_url_table") in the configured format """
+    path = os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], name + ".csv")
+    return read_table(path, get_table_format(config), dtype=ID_DTYPES, columns=columns)
+
+
+def write_intermediate_table(config, df, name, categorical=()):
+    """ Function to write the intermediate table `name` in the configured format """
+    path = os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], name + ".csv")
+    return write_table(df, path, get_table_format(config), categorical=categorical)
+
+
+FACT_CATEGORICAL = ["location", "country", "state", "county", "city", "day"]
+URL_LINK_CATEGORICAL = ["domain", "host", "low_cred_source"]
+
+
+KEYWORDS_FILTER = "keywords_filtered"
+
+
+def us_accounts_table_name(filter_name=""):
+    """ Function to get the name of the US accounts table of a keyword filter ("" for the unfiltered table) """
+    return "US_accounts_" + filter_name + "_table" if filter_name else "US_accounts_table"
+
+
+def get_keyword_filters(config, kw_filter=False):
+    """
+    Function to get the keyword filters of the US accounts tables: the unfiltered table (or, with `kw_filter`, the
+    table filtered on KEYWORDS), plus one table per entry of the optional [KEYWORD_FILTERS] section of the config
+    file (name = comma-separated keywords).
+    """
+    filters = {KEYWORDS_FILTER: KEYWORDS} if kw_filter else {"": None}
+    if config.has_section("KEYWORD_FILTERS"):
+        for name, keywords in config.items("KEYWORD_FILTERS"):
+            filters[name] = [keyword.strip() for keyword in keywords.split(",") if keyword.strip()]
+    return filters
+
 
 def get_urls(urls_entry):
     urls = set()
@@ -43,364 +86,783 @@ def get_dict_path(d, key_list):
     return retval
 
 
-def extract_top_domain(url):
-    """ Function to extract top level domain of an URL """
-    tsd, td, tsu = tldextract.extract(url)
-    domain = td + '.' + tsu
-    return domain.lower()
+## tldextract only using the public suffix list snapshot bundled with the package, so it never goes to the network
+_tld_extract = tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None)
+DOMAIN_CACHE_SIZE = 1000000
 
 
-HTTP_TIMEOUT = 20
+@lru_cache(maxsize=DOMAIN_CACHE_SIZE)
+def _registered_domain(host):
+    ext = _tld_extract(host)
+    domain = ext.domain + '.' + ext.suffix
+    return domain.lower()
 
-def infer_base_url(domain):
-    """Fetch the base URL of a domain by sending HTTP HEAD request."""
-    try:
-        r = requests.head(
-            domain,
-            allow_redirects=True,
-            timeout=HTTP_TIMEOUT)
-        base_url = r.url
-        if not base_url.endswith('/'):
-            base_url = base_url + '/'
-    except Exception as e:
-        print(e)
-        base_url = domain
-    return base_url
+
+@lru_cache(maxsize=DOMAIN_CACHE_SIZE)
+def extract_top_domain(url):
+    """ Function to extract top level domain of an URL (memoized on the URL and on its host) """
+    return _registered_domain(lenient_netloc(url).lower())
 
 
 def expand_urls(config):
 
-    short_link_services = [
-        'bit.ly',
-        'dlvr.it',
-        'liicr.nl',
-        'tinyurl.com',
-        'goo.gl',
-        'ift.tt',
-        'ow.ly',
-        'fxn.ws',
-        'buff.ly',
-        'back.ly',
-        'amzn.to',
-        'nyti.ms',
-        'nyp.st',
-        'dailysign.al',
-        'j.mp',
-        'wapo.st',
-        'reut.rs',
-        'drudge.tw',
-        'shar.es',
-        'sumo.ly',
-        'rebrand.ly',
-        'covfefe.bz',
-        'trib.al',
-        'yhoo.it',
-        't.co',
-        'shr.lc',
-        'po.st',
-        'dld.bz',
-        'bitly.com',
-        'crfrm.us',
-        'flip.it',
-        'mf.tt',
-        'wp.me',
-        'voat.co',
-        'zurl.co',
-        'fw.to',
-        'mol.im',
-        'read.bi',
-        'disq.us',
-        'tmsnrt.rs',
-        'usat.ly',
-        'aje.io',
-        'sc.mp',
-        'gop.cm',
-        'crwd.fr',
-        'zpr.io',
-        'scq.io',
-        'trib.in',
-        'owl.li',
-        'youtu.be',
-    ]
-
-    urls_table = pd.read_csv(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], "tweet_url_table.csv"),
-                             usecols=["tweet_id", "url"])
+    urls_table = read_intermediate_table(config, "tweet_url_table", columns=["tweet_id", "url"])
 
     urls_tweet_id = dict()
     for ix, row in urls_table.iterrows():
         url = row["url"]
         tweet_id = row["tweet_id"]
         domain = extract_top_domain(url)
-        if domain in short_link_services:
+        if domain in SHORT_LINK_SERVICES:
             urls_tweet_id[url] = tweet_id
 
-    print("No. urls to expand: " + str(urls_tweet_id.__len__()))
-
-    q = queue.Queue()
+    ## short URLs already expanded in previous runs are not requested again
+    cache = ExpansionCache.from_config(config)
+    cached = cache.expanded_urls()
+    to_expand = [url for url in urls_tweet_id if url not in cached]
+    print("No. urls to expand: " + str(to_expand.__len__()) + " (" + str(urls_tweet_id.__len__() - to_expand.__len__())
+          + " already in the cache)")
 
-    def expand_domain(short_url):
-        expanded_url = infer_base_url(short_url)
-        top_domain = extract_top_domain(expanded_url)
-        q.put([short_url, expanded_url, top_domain])
-        print("Working on {}, {} ".format(short_url, len(q.queue)))
+    def record(short_url, expanded_url, status, hops=None):
+        cache.add(short_url, expanded_url, extract_top_domain(expanded_url), status, hops)
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=30) as executor:
-        executor.map(expand_domain, list(urls_tweet_id.keys()))
-
-    res_df = pd.DataFrame(list(q.queue), columns=['short_url', 'expanded_url', 'top_domain'])
+    ## expanding with asynchronous HEAD requests, see the [EXPANSION] section of the config file
+    stats = dict()
+    results = expand_urls_async(to_expand, on_result=record, stats=stats, **get_expansion_settings(config))
+    print("URLs retried: {retried}, parked: {parked}, failed: {failed}".format(**stats))
 
     print("Updating links")
-    expanded_urls_dict = dict()
-    for ix, row in res_df.iterrows():
-        old = row["short_url"]
-        new = row["expanded_url"]
-        if old == new:  # it wasn't expanded: lets try with urlexpander
+    for old, new, status, hops in results:
+        ## it wasn't expanded: lets try with urlexpander, unless its host was parked or kept failing (throttled,
+        ## unavailable or unreachable), as urlexpander would request it again serially, without any limit
+        if old == new and status != "CircuitOpen" and not is_retryable(status):
             try:
                 new_v2 = urlexpander.expand(old)
                 if new_v2:
-                    new = new_v2
+                    record(old, new_v2, "urlexpander")
             except:
                 pass
-        expanded_urls_dict[old] = new
-    pkl.dump(expanded_urls_dict,
-             open(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], "urls_expanded.pkl"), "wb"))
+    cache.close()
+
+
+CARMEN_CACHE_SIZE = 1000000
+
+
+class CachedResolver:
+    """
+    Bounded LRU cache in front of a carmen resolver. Carmen only looks at the "location" and "time_zone"
+    fields of the user profile, so the result is cached on them and each distinct profile is resolved once.
+    """
+
+    def __init__(self, resolver, maxsize=CARMEN_CACHE_SIZE):
+        self.resolver = resolver
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve_user(self, account):
+        """Return carmen's result for the user object `account` (None if no location was matched)."""
+        key = (account.get("location"), account.get("time_zone"))
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        result = self.resolver.resolve_tweet({'user': account})
+        self.cache[key] = result
+        if self.cache.__len__() > self.maxsize:
+            self.cache.popitem(last=False)  # evict the least recently used profile
+        return result
+
+
+class StringPool:
+    """Interned strings: each distinct string is stored once and referred to by an integer code."""
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = self.values.__len__()
+            self.values.append(value)
+        return code
+
+    def recode(self, other):
+        """Array mapping the codes of the pool `other` to codes of this pool."""
+        return np.fromiter((self.code(value) for value in other.values), dtype=np.int32,
+                           count=other.values.__len__())
+
+
+def _int_array(typecode, values):
+    """Copy a numpy array of integers into an array.array of type `typecode`."""
+    arr = array(typecode)
+    arr.frombytes(values.astype(np.int64 if typecode == 'q' else np.int32).tobytes())
+    return arr
+
+
+## fields of the carmen Location matched to an account (all None if nothing was matched)
+CARMEN_FIELDS = ["carmen_id", "country", "state", "county", "city"]
+NO_CARMEN_MATCH = (None,) * CARMEN_FIELDS.__len__()
+
+
+def carmen_fields(location):
+    """Return the CARMEN_FIELDS of a carmen Location object as a tuple."""
+    return (location.id, location.country, location.state, location.county, location.city)
+
+
+class TweetTables:
+    """
+    Associations tweet -> object (account, location, carmen location, day, URLs and keywords)
+    collected while processing Twitter data files.
+
+    Tables are kept as compact array columns, which grow in chunks: int64 tweet and account ids, and int32
+    codes of interned strings for locations, days, URLs and keywords, and of interned CARMEN_FIELDS tuples for
+    carmen locations. The account, location, carmen_location and day tables have one row per tweet and share the
+    tweet ids column, URL and keyword tables have one row per (tweet, object) pair, pointing to the row of the tweet.
+    """
+
+    NAMES = ["account", "location", "carmen_location", "day", "url", "keyword"]
+    LIST_NAMES = ["url", "keyword"]  # the mapping is tweet_id -> list(objects) for these tables
+    ID_NAMES = ["account"]  # tables whose objects are (integer) ids
+    RECORD_COLUMNS = {"carmen_location": CARMEN_FIELDS}  # tables whose objects are tuples, written as several columns
+
+    def __init__(self):
+        self.tweet_ids = array('q')
+        self.list_rows = {name: array('q') for name in self.LIST_NAMES}
+        self.values = {name: array('q') if name in self.ID_NAMES else array('i') for name in self.NAMES}
+        self.pools = {name: StringPool() for name in self.NAMES if name not in self.ID_NAMES}
+
+    def __len__(self):
+        return np.unique(np.array(self.tweet_ids, dtype=np.int64)).__len__()
+
+    def add_tweet(self, tweet_id, account_id, location, carmen_location, day, urls, keywords):
+        """Add the associations of one tweet."""
+        row = self.tweet_ids.__len__()
+        self.tweet_ids.append(tweet_id)
+        self.values["account"].append(account_id)
+        self.values["location"].append(self.pools["location"].code(location))
+        self.values["carmen_location"].append(self.pools["carmen_location"].code(carmen_location))
+        self.values["day"].append(self.pools["day"].code(day))
+        for name, objects in [("url", urls), ("keyword", keywords)]:
+            for obj in objects:
+                self.list_rows[name].append(row)
+                self.values[name].append(self.pools[name].code(obj))
+
+    def update(self, other):
+        """Fold the tables of `other` into these ones, as if its tweets were processed after ours."""
+        offset = self.tweet_ids.__len__()
+        self.tweet_ids.extend(other.tweet_ids)
+        for name in self.LIST_NAMES:
+            rows = np.array(other.list_rows[name], dtype=np.int64) + offset
+            self.list_rows[name].frombytes(rows.tobytes())
+        for name in self.NAMES:
+            if name in self.ID_NAMES:
+                self.values[name].extend(other.values[name])
+            else:
+                codes = self.pools[name].recode(other.pools[name])[np.array(other.values[name], dtype=np.int64)]
+                self.values[name].frombytes(codes.astype(np.int32).tobytes())
+
+    def drop_duplicates(self, seen=None):
+        """
+        Drop all but the first occurrence of tweets that appear more than once, and the tweets whose ids are
+        in `seen` (a sorted int64 array of tweets already processed). Returns the number of dropped tweets.
+        """
+        ids = np.array(self.tweet_ids, dtype=np.int64)
+        _, first = np.unique(ids, return_index=True)
+        keep = np.zeros(ids.__len__(), dtype=bool)
+        keep[first] = True
+        if seen is not None and seen.__len__() > 0:
+            pos = np.searchsorted(seen, ids).clip(max=seen.__len__() - 1)
+            keep &= seen[pos] != ids
+        dropped = int(ids.__len__() - keep.sum())
+        if dropped == 0:
+            return 0
+
+        new_rows = np.cumsum(keep) - 1
+        self.tweet_ids = _int_array('q', ids[keep])
+        for name in self.NAMES:
+            values = np.array(self.values[name])
+            if name in self.LIST_NAMES:
+                rows = np.array(self.list_rows[name], dtype=np.int64)
+                keep_rows = keep[rows]
+                self.list_rows[name] = _int_array('q', new_rows[rows[keep_rows]])
+                values = values[keep_rows]
+            else:
+                values = values[keep]
+            self.values[name] = _int_array(self.values[name].typecode, values)
+        return dropped
+
+    def rows(self, name):
+        """
+        Return the tweet ids and objects of table `name`, with the semantics of a dict tweet_id -> object (or
+        tweet_id -> list of objects): tweets in order of first appearance, with the last object seen for a
+        tweet (or all its objects, in order).
+        """
+        if name in self.LIST_NAMES:
+            ids = np.array(self.tweet_ids, dtype=np.int64)[np.array(self.list_rows[name], dtype=np.int64)]
+            values = np.array(self.values[name])
+            _, first, inverse = np.unique(ids, return_index=True, return_inverse=True)
+            rank = np.empty(first.__len__(), dtype=np.int64)
+            rank[np.argsort(first)] = np.arange(first.__len__())
+            order = np.argsort(rank[inverse], kind='stable')
+        else:
+            ids = np.array(self.tweet_ids, dtype=np.int64)
+            values = np.array(self.values[name])
+            _, first = np.unique(ids, return_index=True)
+            _, last_reversed = np.unique(ids[::-1], return_index=True)
+            last = ids.__len__() - 1 - last_reversed
+            by_first = np.argsort(first)
+            ids, values = ids[first[by_first]], values[last[by_first]]
+            order = np.arange(ids.__len__())
+        return ids[order], values[order]
+
+    def dump(self, out_dir, table_format="csv"):
+        """
+        Write one |tweet_id|object| table per association in `out_dir`, as .csv or as .parquet
+        (with int64 tweet/account ids and dictionary-encoded strings).
+        """
+        for name in self.NAMES:
+            ids, values = self.rows(name)
+            filepath = os.path.join(out_dir, "tweet_" + name + "_table.csv")
+            if name in self.RECORD_COLUMNS:
+                self._dump_records(filepath, name, ids, values, table_format)
+                continue
+            if table_format == "parquet":
+                if name not in self.ID_NAMES:
+                    values = pd.Categorical.from_codes(values, categories=self.pools[name].values)
+                df = pd.DataFrame({'tweet_id': ids, name: values})
+                write_table(df, filepath, table_format)
+                continue
+            if name not in self.ID_NAMES:
+                strings = self.pools[name].values
+                values = [strings[code] for code in values.tolist()]
+            else:
+                values = values.tolist()
+            with open(filepath, 'w', newline='') as csvfile:
+                writer = csv.writer(csvfile, delimiter=',')
+                writer.writerow(['tweet_id', name])
+                writer.writerows(zip(ids.tolist(), values))
+
+    def _dump_records(self, filepath, name, ids, codes, table_format):
+        """Write a table whose objects are tuples, with one column per field (None is written as NA)."""
+        columns = self.RECORD_COLUMNS[name]
+        records = self.pools[name].values
+        if table_format == "parquet":
+            df = pd.DataFrame({'tweet_id': ids})
+            for i, column in enumerate(columns):
+                field = [record[i] for record in records]
+                if column.endswith("_id"):
+                    df[column] = pd.array(field, dtype="Int64")[codes]
+                else:
+                    df[column] = pd.Categorical(field)[codes]
+            write_table(df, filepath, table_format)
+            return
+        with open(filepath, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile, delimiter=',')
+            writer.writerow(['tweet_id'] + columns)
+            writer.writerows((tweet_id,) + records[code] for tweet_id, code in zip(ids.tolist(), codes.tolist()))
+
+    @classmethod
+    def table_files(cls, table_format="csv"):
+        """Names of the files written by `dump`."""
+        return ["tweet_" + name + "_table." + table_format for name in cls.NAMES]
+
+    @classmethod
+    def _read_columns(cls, filepath, name, table_format):
+        """Return the tweet ids (int64 array) and objects (list) of a table written by `dump`."""
+        if table_format == "parquet":
+            df = read_table(filepath, table_format)
+            if name in cls.RECORD_COLUMNS:
+                fields = df[cls.RECORD_COLUMNS[name]].astype(object)
+                fields = fields.where(fields.notna(), None)
+                return df['tweet_id'].to_numpy(dtype=np.int64), list(fields.itertuples(index=False, name=None))
+            return df['tweet_id'].to_numpy(dtype=np.int64), df[name].tolist()
+        with open(filepath, 'r', newline='') as csvfile:
+            reader = csv.reader(csvfile, delimiter=',')
+            next(reader)  # header
+            columns = list(zip(*reader))
+        if not columns:
+            return np.empty(0, dtype=np.int64), []
+        if name in cls.RECORD_COLUMNS:
+            fields = [[(int(v) if column.endswith("_id") else v) if v != '' else None for v in values]
+                      for column, values in zip(cls.RECORD_COLUMNS[name], columns[1:])]
+            return np.array(columns[0], dtype=np.int64), list(zip(*fields))
+        return np.array(columns[0], dtype=np.int64), list(columns[1])
+
+    @classmethod
+    def load(cls, out_dir, table_format="csv"):
+        """Read back tables written by `dump`."""
+        tables = cls()
+        for name in cls.NAMES:
+            filepath = os.path.join(out_dir, "tweet_" + name + "_table.csv")
+            ids, values = cls._read_columns(filepath, name, table_format)
+            if name == "account":  # the other per-tweet tables have the same tweet ids
+                tables.tweet_ids.frombytes(ids.tobytes())
+                sorter = np.argsort(ids, kind='stable')
+                sorted_ids = ids[sorter]
+            elif name in cls.LIST_NAMES:  # tweet ids are unique in dumped tables, find their rows
+                rows = sorter[np.searchsorted(sorted_ids, ids)]
+                tables.list_rows[name].frombytes(rows.tobytes())
+            if name in cls.ID_NAMES:
+                tables.values[name].frombytes(np.array(values, dtype=np.int64).tobytes())
+            else:
+                codes = np.fromiter((tables.pools[name].code(value) for value in values), dtype=np.int32,
+                                    count=values.__len__())
+                tables.values[name].frombytes(codes.tobytes())
+        return tables
+
+
+def process_tweet_file(file, resolver, keywords):
+    """
+    Function to associate the tweets of a single Twitter data file with URLs, keywords, accounts and locations.
+    Parameters:
+        file (str): path of the file, with one tweet json per line
+        resolver (CachedResolver): a cached carmen resolver with locations already loaded
+        keywords (KeywordMatcher): compiled keywords to match in the tweets
+    Output:
+        A TweetTables object with the associations found in the file
+    """
+    tables = TweetTables()
+
+    for line in iter_tweet_lines(file):  # stream lines lazily (file can be .json, .json.gz or .json.zst)
+        try:
+            j = load_tweet(line)  # only the fields used below are parsed
+            tweet_id = int(j["id_str"])
+
+            ## 1) extracting all URLs from tweets/retweets (including extended) ##
+            found_urls = set()
+            urls_entry = get_dict_path(j, ['entities', 'urls'])
+            if urls_entry:
+                found_urls = found_urls.union(get_urls(urls_entry))
+            urls_entry = get_dict_path(j, ['extended_tweet', 'entities', 'urls'])
+            if urls_entry:
+                found_urls = found_urls.union(get_urls(urls_entry))
+            urls_entry = get_dict_path(j, ['retweeted_status', 'entities', 'urls'])
+            if urls_entry:
+                found_urls = found_urls.union(get_urls(urls_entry))
+            urls_entry = get_dict_path(j, ['retweeted_status', 'extended_tweet', 'entities', 'urls'])
+            if urls_entry:
+                found_urls = found_urls.union(get_urls(urls_entry))
+
+            tweet_urls = []
+            for url in sorted(found_urls):  # iterate over the SET of found URLs (sorted to be deterministic)
+                domain = extract_top_domain(url)
+                if domain == "twitter.com":  # ignore twitter.com
+                    continue
+                # associate tweet_id and url
+                tweet_urls.append(url)
+
+            ## 2) extracting account, its location and matching it with carmen ##
+            account = j["user"]
+            account_id = int(j["user"]["id_str"])
+
+            location = str(account["location"])
+
+            result = resolver.resolve_user(account)
+            if not result:
+                match = NO_CARMEN_MATCH
+            else:
+                match = carmen_fields(result[1])
+                # result[1] is a Location() object, e.g. Location(country='United Kingdom', state='England', county='London', city='London', known=True, id=2206)
+
+            ## 3) match keywords in the tweet ##
+            found_keywords = sorted(search_tweet_for_keywords(j, keywords))
+
+            ## 4) day of the tweet, from its creation time (not from the name of the file) ##
+            day = created_at_day(j.get("created_at"))
+
+            ## all the associations of the tweet are added at once
+            tables.add_tweet(tweet_id, account_id, location, match, day, tweet_urls, found_keywords)
+
+        except Exception as e:
+            print(e)
+            print(line)
+    return tables
+
+
+MANIFEST_FILE = "build_tables_manifest.json"
+TABLES_VERSION = 3  # layout of the partial tables, files processed with an older layout are processed again
+
+
+def file_sha1(file, block_size=16 * 1024 * 1024):
+    """ Function to compute the SHA-1 hash of a file, reading it in blocks """
+    h = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def is_processed(file, entry):
+    """
+    Function to check whether `file` was already processed according to its manifest `entry`, i.e. its
+    partial tables exist (with the current layout) and it has the same size and modification time (or, if only the
+    latter changed, the same hash).
+    """
+    if entry is None or entry.get("tables_version") != TABLES_VERSION:
+        return False
+    if not all(os.path.exists(os.path.join(entry["partial_dir"], table)) for table in entry["tables"]):
+        return False
+    stat = os.stat(file)
+    if stat.st_size != entry["size"]:
+        return False
+    if stat.st_mtime != entry["mtime"] and file_sha1(file) != entry["sha1"]:
+        return False
+    entry["mtime"] = stat.st_mtime
+    return True
+
+
+## state of each worker process, set by _init_worker
+_worker_resolver = None
+_worker_keywords = None
+
+
+def _init_worker():
+    global _worker_resolver, _worker_keywords
+    ## Initialize carmen geolocation
+    resolver = get_resolver()
+    resolver.load_locations()
+    _worker_resolver = CachedResolver(resolver)
+    ## load file of keywords
+    _worker_keywords = KeywordMatcher(load_keywords_file('keywords.txt'))
+
+
+def _process_tweet_file_worker(file, partial_dir, table_format):
+    """
+    Process a single file and write its partial tables in `partial_dir`.
+    Returns the manifest entry of the file and the carmen cache hits and misses for this file.
+    """
+    print("Processing : " + str(file))
+    start = timeit.default_timer()
+    stat = os.stat(file)  # taken before reading, so that data appended meanwhile is seen as a change next time
+    entry = {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": file_sha1(file),
+             "partial_dir": partial_dir, "tables": TweetTables.table_files(table_format),
+             "tables_version": TABLES_VERSION}
+    hits, misses = _worker_resolver.hits, _worker_resolver.misses
+    tables = process_tweet_file(file, _worker_resolver, _worker_keywords)
+    entry["duplicates"] = tables.drop_duplicates()  # tweets replayed within the file
+    os.makedirs(partial_dir, exist_ok=True)
+    tables.dump(partial_dir, table_format)
+    end = timeit.default_timer()
+    print("Processed " + str(file) + " in " + str(end - start) + " seconds")
+    return entry, _worker_resolver.hits - hits, _worker_resolver.misses - misses
 
 
 ## Function to build tables to associate tweets with URLs, keywords, accounts and locations
-def build_tables(config):
+def build_tables(config, workers=1, force=False):
     """
     Function to associate tweets with URLs, keywords, accounts and locations.
     Parameters:
         config (dict): A dictionary with config information about paths and filenames
+            (Twitter data files can be .json, .json.gz or .json.zst)
+        workers (int): number of worker processes. With more than one worker each file is processed
+            in its own process.
+        force (bool): reprocess all files, ignoring the manifest
     Output:
+        Each file's partial tables are written in INTERMEDIATE_DATA_DIR/partial_tables and recorded (with the
+        size, modification time and hash of the file) in INTERMEDIATE_DATA_DIR/build_tables_manifest.json
+        as soon as the file is done, so that a rerun only processes new or changed files. The partial tables
+        are then merged in file order, so that the output does not depend on the number of workers.
+        Tweets replayed by the stream (same id) are kept only once, the first time they are seen.
         It saves several dataframes with two columns depending on the object associated:
         1) | tweet_id | account_id |
         2) |tweet_id | location |
         ... etc
     """
 
-    ## Initialize carmen geolocation
-
-    resolver = get_resolver()
-    resolver.load_locations()
-
-    ## dictionaries for the association tweet -> object
-    tweet_account = defaultdict()
-    tweet_location = defaultdict()
-    tweet_carmen_location = defaultdict()
-    tweet_url = defaultdict(list)
-    tweet_keyword = defaultdict(list)
-
-    ## load file of keywords
-    keywords = load_keywords_file('keywords.txt')
-
-    for file in sorted(glob.glob(
-            config["PATHS"]["TW_FILES_FOLDER"] + "/*json")):  # iterating over all Twitter data files
-        print("Processing : " + str(file))
-        start = timeit.default_timer()  # to monitor running time
-        tweet_url = defaultdict(list)
-        with open(file, 'r') as f:
-            for line in f.readlines():
-                try:
-                    j = json.loads(line)
-                    tweet_id = j["id_str"]
-
-                    ## 1) extracting all URLs from tweets/retweets (including extended) ##
-                    found_urls = set()
-                    urls_entry = get_dict_path(j, ['entities', 'urls'])
-                    if urls_entry:
-                        found_urls = found_urls.union(get_urls(urls_entry))
-                    urls_entry = get_dict_path(j, ['extended_tweet', 'entities', 'urls'])
-                    if urls_entry:
-                        found_urls = found_urls.union(get_urls(urls_entry))
-                    urls_entry = get_dict_path(j, ['retweeted_status', 'entities', 'urls'])
-                    if urls_entry:
-                        found_urls = found_urls.union(get_urls(urls_entry))
-                    urls_entry = get_dict_path(j, ['retweeted_status', 'extended_tweet', 'entities', 'urls'])
-                    if urls_entry:
-                        found_urls = found_urls.union(get_urls(urls_entry))
-
-                    for url in found_urls:  # iterate over the SET of found URLs
-                        domain = extract_top_domain(url)
-                        if domain == "twitter.com":  # ignore twitter.com
-                            continue
-                        # associate tweet_id and url
-                        tweet_url[tweet_id].append(url)
-
-                    ## 2) extracting account, its location and matching it with carmen ##
-                    account = j["user"]
-                    account_id = j["user"]["id_str"]
-
-                    tweet_account[tweet_id] = account_id
-
-                    tweet_location[tweet_id] = str(account["location"])
-
-                    result = resolver.resolve_tweet({'user': account})
-                    if not result:
-                        match = "No match!"
-                    else:
-                        match = str(result[1])
-                        # result[1] is a Location() object, e.g. Location(country='United Kingdom', state='England', county='London', city='London', known=True, id=2206)
-
-                    tweet_carmen_location[tweet_id] = match
-
-                    ## 3) match keywords in the tweet ##
-                    found_keywords = search_tweet_for_keywords(j, keywords)
-                    for keyword in found_keywords:
-                        tweet_keyword[tweet_id].append(keyword)
-
-                except Exception as e:
-                    print(e)
-                    print(line)
-    print("Processed tweets: " + str(tweet_account.__len__()))
-
-    i = 0
-    ## Manually writing tables to .csv files ##
-    names = ["account", "location", "carmen_location", "url", "keyword"]
-    for data in [tweet_account, tweet_location, tweet_carmen_location, tweet_url,
-                 tweet_keyword]:  # looping over different dictionaries
-        name = names[i]
-        print("Dumping table for "+str(name))
-        i += 1  # increment to get to other names
-
-        filepath = os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], "tweet_" + name + "_table.csv")
-        with open(filepath, 'w', newline='') as csvfile:
-            fieldnames = ['tweet_id', name]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=',')
-            writer.writeheader()
-            for k in data:
-                if name in ["url", "keyword"]: # the mapping is tweet_id -> list(objects), need a different way to write this
-                    for val in data[k]:
-                        writer.writerow({'tweet_id': k, name: val}) 
-                else:
-                    writer.writerow({'tweet_id': k, name: data[k]})
+    files = list_tweet_files(config["PATHS"]["TW_FILES_FOLDER"])  # iterating over all Twitter data files
+    table_format = get_table_format(config)
+    partial_tables_dir = os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], "partial_tables")
+    partial_dirs = {file: os.path.join(partial_tables_dir, os.path.basename(file)) for file in files}
+
+    manifest_path = os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], MANIFEST_FILE)
+    manifest = {} if force else load_manifest(manifest_path)
+    to_process = [file for file in files if not is_processed(file, manifest.get(os.path.basename(file)))]
+    print("Files to process: " + str(to_process.__len__()) + " out of " + str(files.__len__()))
+
+    cache_hits, cache_misses = 0, 0
+    partial_dirs_to_process = [partial_dirs[file] for file in to_process]
+    table_formats = [table_format] * to_process.__len__()
+    if workers > 1 and to_process:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+        results = executor.map(_process_tweet_file_worker, to_process, partial_dirs_to_process, table_formats)
+    else:
+        executor = None
+        if to_process:
+            _init_worker()
+        results = map(_process_tweet_file_worker, to_process, partial_dirs_to_process, table_formats)
+    try:
+        for file, (entry, hits, misses) in zip(to_process, results):
+            ## checkpoint: record the file as soon as its partial tables are written
+            manifest[os.path.basename(file)] = entry
+            save_manifest(manifest, manifest_path)
+            cache_hits += hits
+            cache_misses += misses
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    save_manifest(manifest, manifest_path)  # also records the new modification times of unchanged files
+    print("Carmen cache: " + str(cache_hits) + " hits, " + str(cache_misses) + " misses")
+
+    ## merging partial tables in file order, dropping tweets already seen in previous files
+    tables = TweetTables()
+    seen = np.empty(0, dtype=np.int64)  # sorted ids of the tweets merged so far
+    duplicates_within_files = sum(manifest[os.path.basename(file)].get("duplicates", 0) for file in files)
+    duplicates_across_files = 0
+    for file in files:
+        partial = TweetTables.load(partial_dirs[file], table_format)
+        duplicates_across_files += partial.drop_duplicates(seen)
+        # tweet ids grow over time, so the concatenation is almost sorted and a stable (merge) sort is fast
+        seen = np.sort(np.concatenate([seen, np.array(partial.tweet_ids, dtype=np.int64)]), kind='stable')
+        tables.update(partial)
+    print("Processed tweets: " + str(tables.__len__()))
+    print("Duplicate tweets dropped: " + str(duplicates_within_files) + " within files, " +
+          str(duplicates_across_files) + " across files")
+
+    ## Manually writing tables to .csv (or .parquet) files ##
+    print("Dumping tables")
+    tables.dump(config["PATHS"]["INTERMEDIATE_DATA_DIR"], table_format)
 
 
 def merge_tables(config):
     """
     Function to merge all intermediate tables (i.e. url, account, location, carmen_location, keyword). It also takes into account
-    expanded URLs before merging the tables.
+    expanded URLs (from the expansion cache written by `expand_urls`) before merging the tables.
+    The output is a star schema, so that its size is linear in the number of tweets: a tweet fact table (one row per tweet),
+    and link tables for the URLs and keywords of tweets (the "tweet_keyword_table" written by `build_tables`).
     Parameters:
         config (dict): A dictionary with config information about paths and filenames. It is used also to get the Iffy+ list of low-cred websites
     Output:
-        It saves a dataframe with several columns:
+        It saves a "tweet_fact_table" dataframe with columns:
         - "tweet_id", the id of the tweet
-        - "url", the URL shared (if present, else NA)
-        - "expanded", the expanded version of the URL if it was shortened; it is equal to "url" if it was not expanded (if present, else NA)
-        - "domain", the domain of the URL shared (if present, else NA)
-        - "account_id", the id of Twitter user who shared the tweet;
+        - "account", the id of Twitter user who shared the tweet;
         - "location", the "location" field of Twitter user objects (it can be "None")
-        - "carmen_location", the result of using "carmen" API on each location (converted to string) = Location() if matches something, else "No match!"
-        - "low_cred_flag", a boolean flag indicating whether the "domain" shared belongs to the low-credibility list
-        - "keyword", the keyword matching that tweet (from the "keywords.txt" list of terms used in Covaxxy)
+        - "carmen_id", "country", "state", "county", "city", the fields of the Location() matched by the "carmen" API on each
+        account (NA if nothing was matched, or if the field is unknown)
+        - "day", the day the tweet was created (YYYY-MM-DD, UTC)
+        - "low_cred_flag", a boolean flag indicating whether any URL shared in the tweet belongs to the low-credibility list
+        and a "tweet_url_link_table" dataframe with one row per URL of a tweet and columns:
+        - "tweet_id", the id of the tweet
+        - "url", the URL shared
+        - "expanded", the expanded version of the URL if it was shortened; it is equal to "url" if it was not expanded
+        - "domain", the domain of the URL shared
+        - "host", the host of the (expanded) URL shared
+        - "low_cred_source", the entry of the low-credibility list matching "host" (else NA)
+        - "low_cred_flag", a boolean flag indicating whether the URL belongs to the low-credibility list
     """
-    low_cred_df = pd.read_csv(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], config["FILES"]["LOW_CRED_FILE"]))
-    low_cred_sources = set(low_cred_df["site"].values)
+    low_cred_index = LowCredibilityIndex.from_config(config)
 
     start = timeit.default_timer()
 
-    tweet_url = pd.read_csv(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], "tweet_url_table.csv"))
-    try:
-        tweet_url_expanded_dict = pkl.load(
-            open(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], "urls_expanded.pkl"), "rb"))
-    except:
+    tweet_url = read_intermediate_table(config, "tweet_url_table")
+    if os.path.exists(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], EXPANSION_CACHE_FILE)):
+        cache = ExpansionCache.from_config(config)
+        expansions = cache.read()
+        cache.close()
+        tweet_url_expanded_dict = dict(zip(expansions["short_url"], expansions["expanded_url"]))
+    else:
         tweet_url_expanded_dict = {}
         print(
             "You didn't expand URLs. Press CTRL+C to interrupt and run the expanding script if you don't want to miss relevant URLs.")
-    expanded_urls = []
-    domains = []
-    for ix, row in tweet_url.iterrows():  # taking into account expanded version of certain urls
-        url = row["url"]
-        if url in tweet_url_expanded_dict:
-            expanded = tweet_url_expanded_dict[url]
-        else:
-            expanded = url
-        expanded_urls.append(expanded)
-        domain = extract_top_domain(expanded)
-        domains.append(domain)
+    ## taking into account expanded version of certain urls: each unique URL is expanded and mapped to its domain
+    ## and low-credibility source once, then joined back to the rows by its code
+    url_codes, unique_urls = pd.factorize(tweet_url["url"])
+    unique_urls = np.asarray(unique_urls, dtype=object)
+    unique_expanded = pd.Series(unique_urls).map(tweet_url_expanded_dict)
+    unique_expanded = unique_expanded.where(unique_expanded.notna(), unique_urls).values
+    unique_domains = np.array([extract_top_domain(url) for url in unique_expanded], dtype=object)
+    unique_hosts = np.array([lenient_netloc(url).lower() for url in unique_expanded], dtype=object)
+    unique_sources = low_cred_index.lookup_many(unique_hosts)
 
-    tweet_url["expanded"] = expanded_urls
-    tweet_url["domain"] = domains
+    tweet_url["expanded"] = unique_expanded[url_codes]
+    tweet_url["domain"] = unique_domains[url_codes]
+    tweet_url["host"] = unique_hosts[url_codes]
+    tweet_url["low_cred_source"] = unique_sources[url_codes]
+    tweet_url["low_cred_flag"] = tweet_url["low_cred_source"].notna()
 
-    tweet_account = pd.read_csv(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], "tweet_account_table.csv"))
+    tweet_account = read_intermediate_table(config, "tweet_account_table")
 
-    tweet_location = pd.read_csv(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], "tweet_location_table.csv"))
+    tweet_location = read_intermediate_table(config, "tweet_location_table")
 
-    tweet_carmen_location = pd.read_csv(
-        os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], "tweet_carmen_location_table.csv"))
+    tweet_carmen_location = read_intermediate_table(config, "tweet_carmen_location_table")
 
-    tweet_keyword = pd.read_csv(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], "tweet_keyword_table.csv"))
+    tweet_day = read_intermediate_table(config, "tweet_day_table")
 
-    ## merging everything, how="left" is to retain tweets without URLs nor keywords
-    data = tweet_account.merge(tweet_location, on="tweet_id").merge(
-        tweet_carmen_location, on="tweet_id").merge(tweet_keyword, on="tweet_id", how="left").merge(tweet_url,
-                                                                                                    on="tweet_id",
-                                                                                                    how="left")
-    ## checking which tweets contain low-credibility
-    data["low_cred_flag"] = data.domain.apply(lambda x: x in low_cred_sources)
+    ## merging the per-tweet tables (one row per tweet); keywords and URLs stay in their own link tables
+    tweets = tweet_account.merge(tweet_location, on="tweet_id").merge(tweet_carmen_location, on="tweet_id").merge(
+        tweet_day, on="tweet_id")
+    ## checking which tweets contain low-credibility (URLs whose host is a listed site or one of its subdomains)
+    tweets["low_cred_flag"] = tweets["tweet_id"].isin(tweet_url.loc[tweet_url["low_cred_flag"], "tweet_id"].values)
 
-    ## writing dataframe using csv file because it's safer
-    with open(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], "tweet_merged_table.csv"), 'w',
-              newline='') as csvfile:
-        fieldnames = data.columns
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=',')
-        writer.writeheader()
-        for ix, row in data.iterrows():
-            writer.writerow({k: row[k] for k in row.index})
+    ## writing dataframes (as .csv or .parquet, see INTERMEDIATE_FORMAT in the config file)
+    write_intermediate_table(config, tweets, "tweet_fact_table", categorical=FACT_CATEGORICAL)
+    write_intermediate_table(config, tweet_url, "tweet_url_link_table", categorical=URL_LINK_CATEGORICAL)
 
     end = timeit.default_timer()
     print("Running time: " + str(end - start) + " seconds")
 
 
+def _fill_none(column):
+    """ Function to replace missing values of a (possibly categorical) string column with "None" """
+    if isinstance(column.dtype, pd.CategoricalDtype) and "None" not in column.cat.categories:
+        column = column.cat.add_categories("None")
+    return column.fillna("None")
+
+
 def get_US_accounts_table(config, kw_filter=False, keywords=KEYWORDS):
     """
     Function to extract final table with statistics for US-based accounts, also filtering for tweets which match certain keywords.
 
     """
+    get_US_accounts_tables(config, {KEYWORDS_FILTER: keywords} if kw_filter else {"": None})
 
-    df = pd.read_csv(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"],
-                                  "tweet_merged_table.csv"))
-    if kw_filter:
-        df = df[df["keyword"].isin(keywords)]
 
-    us_data = df[df["carmen_location"].str.contains("United States")]  # filtering for US accounts
+def _accounts_table(stats, i, us_data):
+    """ Function to build the US accounts table of the i-th filter from the grouped stats of `get_US_accounts_tables` """
+    accounts = stats[stats["tweets_" + str(i)] > 0]
+    first = accounts["first_" + str(i)].values
+    final_df = pd.DataFrame({
+        "account_id": accounts.index.get_level_values(-1).values.astype(np.int64),
+        "state": _fill_none(us_data["state"].iloc[first].reset_index(drop=True)),
+        "county": _fill_none(us_data["county"].iloc[first].reset_index(drop=True)),
+        "no_tweets": accounts["tweets_" + str(i)].values.astype(np.int64),
+        "no_low_cred_tweets": accounts["low_cred_" + str(i)].values.astype(np.int64),
+    })
+    final_df["fraction_misinfo"] = (final_df["no_low_cred_tweets"] / final_df["no_tweets"]) * 100
+    return final_df
 
-    # Computing stats for US accounts
-    acc_stats = dict()
-    for ix, data in us_data.groupby("account"):
-        location = eval(str(data.carmen_location.values[0]))
 
-        no_tweets = data["tweet_id"].nunique()
-        try:
-            no_low_cred_tweets = data["low_cred_flag"].value_counts()[True]
-        except:
-            no_low_cred_tweets = 0
-
-        acc_stats[ix] = {'no_tweets': no_tweets, 'no_low_cred_tweets': no_low_cred_tweets,
-                         'state': str(location.state), 'county': str(location.county)}
-
-    df = pd.DataFrame.from_dict(acc_stats, orient="index")
-    df = df.reset_index()
-    df = df.rename(columns={'index': 'account_id'})
-
-    ## now group by account and sum stats
-    acc_stats = dict()
-    for ix, data in df.groupby("account_id"):
-        no_tweets = data["no_tweets"].sum()
-        no_low_cred_tweets = data["no_low_cred_tweets"].sum()
-        fraction_misinfo = (no_low_cred_tweets / no_tweets) * 100
-        acc_stats[ix] = {'state': data['state'].values[0], 'county': data['county'].values[0],
-                         'no_tweets': no_tweets, 'no_low_cred_tweets': no_low_cred_tweets,
-                         'fraction_misinfo': fraction_misinfo}
-
-    final_df = pd.DataFrame.from_dict(acc_stats, orient="index")
-    final_df = final_df.reset_index()
-    final_df = final_df.rename(columns={'index': 'account_id'})
-
-    kw = "_keywords_filtered_" if kw_filter else ""
+def get_US_accounts_tables(config, filters, daily=False):
+    """
+    Function to extract the tables with statistics for US-based accounts for several keyword filters at once, with a
+    single read of the tweet tables and a single grouped pass over the tweets.
+    Parameters:
+        config (dict): A dictionary with config information about paths and filenames
+        filters (dict): filter name -> list of keywords (only tweets matching at least one of them are counted), or
+        None to count all tweets. The table of each filter is written as `us_accounts_table_name(name)`
+        daily (bool): also write the table of each filter for each day, as "{day}_" + `us_accounts_table_name(name)`
+        in TABLES_DAILY_FOLDER (days are bucketed in the same grouped pass)
+    Output:
+        For each filter, a table with one row per US account with at least one tweet passing the filter and columns
+        "account_id", "state", "county" (of the first tweet passing the filter, "None" if unknown), "no_tweets",
+        "no_low_cred_tweets" and "fraction_misinfo" (percentage of tweets with low-credibility URLs)
+    """
+    df = read_intermediate_table(config, "tweet_fact_table",
+                                 columns=["tweet_id", "account", "country", "state", "county", "day", "low_cred_flag"])
+    us_data = df[df["country"] == "United States"]  # filtering for US accounts
+    if any(keywords is not None for keywords in filters.values()):
+        tweet_keyword = read_intermediate_table(config, "tweet_keyword_table")
+
+    ## one column per filter and statistic: tweets passing the filter, low-credibility tweets passing the filter, and
+    ## position of the tweet if it passes the filter (the first tweet of the account gives its state and county)
+    no_rows = us_data.__len__()
+    position = np.arange(no_rows)
+    low_cred = us_data["low_cred_flag"].values.astype(bool)
+    columns = {}
+    aggregations = {}
+    for i, keywords in enumerate(filters.values()):
+        if keywords is None:
+            mask = np.ones(no_rows, dtype=bool)
+        else:
+            matching = tweet_keyword.loc[tweet_keyword["keyword"].isin(keywords), "tweet_id"].values
+            mask = us_data["tweet_id"].isin(matching).values
+        columns["tweets_" + str(i)] = mask
+        columns["low_cred_" + str(i)] = mask & low_cred
+        columns["first_" + str(i)] = np.where(mask, position, no_rows)
+        aggregations.update({"tweets_" + str(i): "sum", "low_cred_" + str(i): "sum", "first_" + str(i): "min"})
+
+    ## computing stats of all filters for US accounts in a single grouped pass (the fact table has one row per tweet)
+    if not daily:
+        stats = pd.DataFrame(columns).groupby(us_data["account"].values).agg(aggregations)
+    else:
+        ## grouping by (day, account), the stats of accounts over all days are aggregated from the daily ones
+        day_codes, days = pd.factorize(us_data["day"])
+        daily_stats = pd.DataFrame(columns).groupby([day_codes, us_data["account"].values]).agg(aggregations)
+        stats = daily_stats.groupby(level=1).agg(aggregations)
+
+        daily_folder = config["PATHS"]["TABLES_DAILY_FOLDER"]
+        os.makedirs(daily_folder, exist_ok=True)
+        for day_code, day_stats in daily_stats.groupby(level=0):
+            if day_code < 0:  # tweets without a creation time
+                continue
+            for i, name in enumerate(filters):
+                write_table(_accounts_table(day_stats, i, us_data),
+                            os.path.join(daily_folder, str(days[day_code]) + "_" + us_accounts_table_name(name) + ".csv"),
+                            get_table_format(config), categorical=["state", "county"])
+        print("Daily tables written: " + str(np.unique(day_codes[day_codes >= 0]).__len__()) + " days")
+
+    for i, name in enumerate(filters):
+        write_intermediate_table(config, _accounts_table(stats, i, us_data), us_accounts_table_name(name),
+                                 categorical=["state", "county"])
+
+
+def compare_accounts_tables(old, new):
+    """
+    Function to compare two US accounts tables (e.g. before and after relabeling low-credibility flags).
+    Returns the number of accounts and of (state, county) pairs whose low-credibility statistics changed.
+    """
+    stats = ["no_tweets", "no_low_cred_tweets"]
+    accounts = old[["account_id"] + stats].merge(new[["account_id"] + stats], on="account_id", how="outer",
+                                                  suffixes=("_old", "_new")).fillna(-1)
+    changed_accounts = (accounts[[s + "_old" for s in stats]].values != accounts[[s + "_new" for s in stats]].values)
+    changed_accounts = int(changed_accounts.any(axis=1).sum())
+
+    keys = ["state", "county"]
+    counties = old.groupby(keys, observed=True, dropna=False)[stats].sum().merge(
+        new.groupby(keys, observed=True, dropna=False)[stats].sum(), left_index=True, right_index=True, how="outer",
+        suffixes=("_old", "_new")).fillna(-1)
+    changed_counties = (counties[[s + "_old" for s in stats]].values != counties[[s + "_new" for s in stats]].values)
+    changed_counties = int(changed_counties.any(axis=1).sum())
+    return changed_accounts, changed_counties
+
+
+def relabel_low_credibility(config, filters, daily=False):
+    """
+    Function to recompute low-credibility flags from a new low-credibility list (LOW_CRED_FILE in the config file)
+    without processing tweets again. The URL link table written by `merge_tables` is the host -> tweet index: only
+    hosts are looked up in the new list, and the flags of the tweets whose URLs changed source are recomputed.
+    Then the US accounts tables of the keyword `filters` (and, with `daily`, the daily tables; see
+    `get_US_accounts_tables`) are recomputed.
+    It prints how many accounts and counties changed.
+    """
+    start = timeit.default_timer()
+    low_cred_index = LowCredibilityIndex.from_config(config)
+
+    ## relabeling URLs: each unique host is looked up once
+    tweet_url = read_intermediate_table(config, "tweet_url_link_table")
+    host_codes, unique_hosts = pd.factorize(tweet_url["host"])
+    unique_hosts = np.asarray(unique_hosts, dtype=object)
+    new_sources = pd.Series(low_cred_index.lookup_many(unique_hosts)[host_codes], index=tweet_url.index)
+    changed = (new_sources.fillna("") != tweet_url["low_cred_source"].astype(object).fillna("")).values
+    changed_tweets = tweet_url.loc[changed, "tweet_id"].unique()
+    print("Hosts relabeled: " + str(np.unique(host_codes[changed]).__len__()) + ", tweets affected: "
+          + str(changed_tweets.__len__()))
+
+    tweet_url["low_cred_source"] = new_sources
+    tweet_url["low_cred_flag"] = new_sources.notna()
+    write_intermediate_table(config, tweet_url, "tweet_url_link_table", categorical=URL_LINK_CATEGORICAL)
+
+    ## then the flags of the affected tweets
+
+    tweets = read_intermediate_table(config, "tweet_fact_table")
+    rows = tweets["tweet_id"].isin(changed_tweets).values
+    low_cred_tweets = tweet_url.loc[tweet_url["low_cred_flag"] & tweet_url["tweet_id"].isin(changed_tweets), "tweet_id"]
+    tweets.loc[rows, "low_cred_flag"] = tweets.loc[rows, "tweet_id"].isin(low_cred_tweets.values)
+    write_intermediate_table(config, tweets, "tweet_fact_table", categorical=FACT_CATEGORICAL)
+
+    old_accounts = {name: read_intermediate_table(config, us_accounts_table_name(name)) for name in filters}
+    get_US_accounts_tables(config, filters, daily)
+    for name in filters:
+        new_accounts = read_intermediate_table(config, us_accounts_table_name(name))
+        changed_accounts, changed_counties = compare_accounts_tables(old_accounts[name], new_accounts)
+        print(us_accounts_table_name(name) + ": accounts changed: " + str(changed_accounts) + " (of "
+              + str(new_accounts.__len__()) + "), counties changed: " + str(changed_counties))
 
-    final_df.to_csv(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"],
-                                 "US_accounts_" + kw + "table.csv"), index=False)
+    end = timeit.default_timer()
+    print("Running time: " + str(end - start) + " seconds")
 
 
 if __name__ == "__main__":
@@ -417,15 +879,23 @@ if __name__ == "__main__":
         config = parse_config_file(config_file_path)
         
         kw_filter = args.keywords_filter
+        filters = get_keyword_filters(config, kw_filter)
+        workers = args.workers
+        force = args.force
+
+        if args.relabel:
+            print("Relabeling low-credibility flags.")
+            relabel_low_credibility(config, filters, args.daily)
+            exit(0)
 
         print("Building tables.")
-        build_tables(config)
+        build_tables(config, workers, force)
         print("Expanding URLs.")
         expand_urls(config)
         print("Merging tables.")
         merge_tables(config)
-        print("Getting US accounts table.")
-        get_US_accounts_table(config, kw_filter)
+        print("Getting US accounts tables.")
+        get_US_accounts_tables(config, filters, args.daily)
 
         exit(0)
     except Exception as e:
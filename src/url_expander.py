@@ -0,0 +1,519 @@
+"""
+PURPOSE:
+    - This module expands shortened URLs (e.g. bit.ly, t.co) with
+    asynchronous HTTP HEAD requests, sharing a pool of connections.
+    - Concurrency is bounded globally (MAX_CONNECTIONS) and for each
+    shortener host (MAX_PER_HOST), and every request has a bounded
+    timeout (TIMEOUT, in seconds). Requests to each host are also rate
+    limited with a token bucket (RATE_PER_HOST, per second).
+    - Throttled (429), unavailable (5xx) and timed out requests are
+    retried with exponential backoff (MAX_RETRIES, BACKOFF), and a host
+    that keeps failing (BREAKER_FAILURES consecutive failures) is parked
+    by a circuit breaker for BREAKER_COOLDOWN seconds before its URLs are
+    retried. These can be set in the [EXPANSION] section of the config file.
+    - By default (REDIRECTS=domain), redirects are followed one hop at a
+    time and resolution stops at the first URL that is not a short link:
+    its domain is all that is needed to classify the link, and nested
+    shorteners (t.co -> bit.ly -> publisher) cost fewer requests. With
+    REDIRECTS=final, all redirects are followed to the end.
+    - Expansions are stored in a durable SQLite cache (ExpansionCache),
+    so that a short URL is only expanded once across runs.
+
+DEPENDENCIES:
+    - aiohttp (https://docs.aiohttp.org/)
+"""
+import asyncio
+import datetime
+import json
+import os
+import random
+import sqlite3
+from collections import defaultdict
+from urllib.parse import urljoin, urlsplit
+
+import aiohttp
+import pandas as pd
+
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_PER_HOST = 10
+DEFAULT_TIMEOUT = 20
+DEFAULT_RATE_PER_HOST = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 1
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_COOLDOWN = 30
+DEFAULT_BREAKER_MAX_TRIPS = 3
+DEFAULT_REDIRECTS = "domain"
+REDIRECT_MODES = ["domain", "final"]
+MAX_REDIRECTS = 10
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+RETRY_STATUSES = {"429", "500", "502", "503", "504"}
+PERMANENT_ERRORS = {"TooManyRedirects", "InvalidURL", "InvalidUrlClientError", "NonHttpUrlClientError"}
+EXPANSION_CACHE_FILE = "urls_expanded.sqlite"
+
+## registered domains of URL shortening services
+SHORT_LINK_SERVICES = [
+    'bit.ly',
+    'dlvr.it',
+    'liicr.nl',
+    'tinyurl.com',
+    'goo.gl',
+    'ift.tt',
+    'ow.ly',
+    'fxn.ws',
+    'buff.ly',
+    'back.ly',
+    'amzn.to',
+    'nyti.ms',
+    'nyp.st',
+    'dailysign.al',
+    'j.mp',
+    'wapo.st',
+    'reut.rs',
+    'drudge.tw',
+    'shar.es',
+    'sumo.ly',
+    'rebrand.ly',
+    'covfefe.bz',
+    'trib.al',
+    'yhoo.it',
+    't.co',
+    'shr.lc',
+    'po.st',
+    'dld.bz',
+    'bitly.com',
+    'crfrm.us',
+    'flip.it',
+    'mf.tt',
+    'wp.me',
+    'voat.co',
+    'zurl.co',
+    'fw.to',
+    'mol.im',
+    'read.bi',
+    'disq.us',
+    'tmsnrt.rs',
+    'usat.ly',
+    'aje.io',
+    'sc.mp',
+    'gop.cm',
+    'crwd.fr',
+    'zpr.io',
+    'scq.io',
+    'trib.in',
+    'owl.li',
+    'youtu.be',
+]
+
+
+def get_expansion_settings(config):
+    """Return the URL expansion settings of the [EXPANSION] section of the config file (or their defaults)."""
+    redirects = config.get("EXPANSION", "REDIRECTS", fallback=DEFAULT_REDIRECTS)
+    if redirects not in REDIRECT_MODES:
+        raise ValueError(f"REDIRECTS must be one of {REDIRECT_MODES}, not {redirects}")
+    return {
+        "redirects": redirects,
+        "max_connections": config.getint("EXPANSION", "MAX_CONNECTIONS", fallback=DEFAULT_MAX_CONNECTIONS),
+        "max_per_host": config.getint("EXPANSION", "MAX_PER_HOST", fallback=DEFAULT_MAX_PER_HOST),
+        "timeout": config.getfloat("EXPANSION", "TIMEOUT", fallback=DEFAULT_TIMEOUT),
+        "rate_per_host": config.getfloat("EXPANSION", "RATE_PER_HOST", fallback=DEFAULT_RATE_PER_HOST),
+        "max_retries": config.getint("EXPANSION", "MAX_RETRIES", fallback=DEFAULT_MAX_RETRIES),
+        "backoff": config.getfloat("EXPANSION", "BACKOFF", fallback=DEFAULT_BACKOFF),
+        "breaker_failures": config.getint("EXPANSION", "BREAKER_FAILURES", fallback=DEFAULT_BREAKER_FAILURES),
+        "breaker_cooldown": config.getfloat("EXPANSION", "BREAKER_COOLDOWN", fallback=DEFAULT_BREAKER_COOLDOWN),
+        "breaker_max_trips": config.getint("EXPANSION", "BREAKER_MAX_TRIPS", fallback=DEFAULT_BREAKER_MAX_TRIPS),
+    }
+
+
+def url_host(url):
+    """Return the (lowercase) host of a URL, or an empty string if it has none."""
+    try:
+        return (urlsplit(url).hostname or "").lower()
+    except ValueError:
+        return ""
+
+
+def is_short_link(url):
+    """Whether the host of a URL is one of SHORT_LINK_SERVICES (or one of their subdomains)."""
+    host = url_host(url)
+    return any(host == service or host.endswith("." + service) for service in SHORT_LINK_SERVICES)
+
+
+async def infer_base_url(session, url):
+    """Fetch the URL a short link points to by sending HTTP HEAD request (following redirects).
+        - Returns the expanded URL, the HTTP status and the URLs visited, or the input URL and the error if the
+        request failed
+    """
+    hops = [url]
+    try:
+        async with session.head(url, allow_redirects=True) as r:
+            base_url = str(r.url)
+            status = str(r.status)
+            hops = [str(h.url) for h in r.history] + [base_url]
+        if not base_url.endswith('/'):
+            base_url = base_url + '/'
+    except Exception as e:
+        base_url = url
+        status = type(e).__name__
+    return base_url, status, hops
+
+
+async def resolve_domain_url(session, url, host_limits, allow=None):
+    """Follow the redirects of a short link one hop at a time, until a URL which is not a short link is reached.
+        - Only short link services are requested, each through its HostLimit
+        - `allow(host)`, if given, is called before each request: if it returns False the request is not sent and
+        the resolution stops with the status "CircuitOpen"
+        - Returns the first URL that is not a short link, the HTTP status and the URLs visited, or the input URL
+        and the error if a request failed. If the resolution failed, the last URL visited is the one whose request
+        failed (or was not allowed)
+    """
+    hops = [url]
+    try:
+        while True:
+            if allow is not None and not allow(url_host(hops[-1])):
+                return url, "CircuitOpen", hops
+            async with host_limits[url_host(hops[-1])]:
+                async with session.head(hops[-1], allow_redirects=False) as r:
+                    status = str(r.status)
+                    location = r.headers.get("Location")
+            if r.status not in REDIRECT_STATUSES or location is None:
+                break  # not a redirect: the short link service itself is the end of the chain
+            if hops.__len__() > MAX_REDIRECTS:
+                raise aiohttp.TooManyRedirects(r.request_info, r.history)
+            hops.append(urljoin(hops[-1], location))
+            if not is_short_link(hops[-1]):
+                break
+        base_url = hops[-1]
+        if not base_url.endswith('/'):
+            base_url = base_url + '/'
+    except Exception as e:
+        base_url = url
+        status = type(e).__name__
+    return base_url, status, hops
+
+
+class HostLimit:
+    """Limits the requests sent to one host: at most `max_per_host` at once, and `rate` per second on average
+    (token bucket, with bursts of up to `max_per_host` requests).
+    """
+
+    def __init__(self, max_per_host, rate):
+        self.semaphore = asyncio.Semaphore(max_per_host)
+        self.rate = rate
+        self.capacity = max_per_host
+        self.tokens = max_per_host
+        self.updated = None
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self.updated is not None:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return self
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
+
+
+class CircuitBreaker:
+    """Circuit breaker of a short link host.
+        - After `threshold` consecutive failures the host is parked ("open") for `cooldown` seconds, doubled
+        each time it trips again before recovering; its URLs wait in `parked` meanwhile
+        - Then a single probe request is let through ("half-open"): its success closes the breaker, its failure
+        trips it again
+        - A host that trips more than `max_trips` times in a row is given up for the rest of the run
+    """
+
+    def __init__(self, threshold, cooldown, max_trips):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_trips = max_trips
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.probing = False
+        self.parked = []
+
+    @property
+    def given_up(self):
+        return self.trips > self.max_trips
+
+    def allow(self):
+        """Whether a request may be sent to the host now."""
+        if self.state == "closed":
+            return True
+        if self.state == "half-open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def success(self):
+        """Record a successful request, and return the URLs parked until now."""
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.probing = False
+        released, self.parked = self.parked, []
+        return released
+
+    def failure(self, probe=False):
+        """Record a failed request (`probe` if it was the probe of a half-open breaker), and return whether the
+        breaker tripped.
+        """
+        self.failures += 1
+        if probe or self.state == "closed" and self.failures >= self.threshold:
+            self.state = "open"
+            self.trips += 1
+            self.probing = False
+            return True
+        return False
+
+    def cooldown_time(self):
+        return self.cooldown * 2 ** (self.trips - 1)
+
+
+def is_retryable(status):
+    """Whether a failed expansion may succeed later: throttling (429), server errors (5xx) and network errors."""
+    if status.isdigit():
+        return status in RETRY_STATUSES
+    return status not in PERMANENT_ERRORS
+
+
+class ExpansionScheduler:
+    """Expands short URLs with a pool of workers sharing one session.
+        - Requests to each host go through a HostLimit
+        - URLs that fail with a retryable status are retried up to `max_retries` times, after an exponential
+        backoff (`backoff` * 2^attempt seconds, with jitter)
+        - Failures are counted against the host whose request failed (with REDIRECTS=domain, the host of the
+        failing hop, e.g. bit.ly behind t.co): a CircuitBreaker parks a failing host, and the URLs that reach it
+        are retried later in the run
+        - `stats` counts the URLs that were retried, parked and that failed for good
+    """
+
+    def __init__(self, session, redirects, max_per_host, rate_per_host, max_retries, backoff, breaker_failures,
+                 breaker_cooldown, breaker_max_trips, on_result=None):
+        self.session = session
+        self.redirects = redirects
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.on_result = on_result
+        self.host_limits = defaultdict(lambda: HostLimit(max_per_host, rate_per_host))
+        self.breakers = defaultdict(lambda: CircuitBreaker(breaker_failures, breaker_cooldown, breaker_max_trips))
+        self.queue = asyncio.Queue()
+        self.results = []
+        self.retried = set()
+        self.parked = set()
+        self.failed = set()
+
+    @property
+    def stats(self):
+        return {"retried": self.retried.__len__(), "parked": self.parked.__len__(), "failed": self.failed.__len__()}
+
+    async def run(self, urls, workers):
+        """Expand all `urls` and return the (short_url, expanded_url, status, hops) tuples, in order of completion."""
+        self.remaining = urls.__len__()
+        self.done = asyncio.Event()
+        if self.remaining == 0:
+            self.done.set()
+        for url in urls:
+            self.queue.put_nowait((url, 0))
+        tasks = [asyncio.create_task(self._worker()) for _ in range(workers)]
+        await self.done.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return self.results
+
+    async def _worker(self):
+        while True:
+            url, attempt = await self.queue.get()
+            await self._expand(url, attempt)
+
+    async def _expand(self, url, attempt):
+        requested = {}  # hosts requested for this URL -> whether the request was the probe of a half-open breaker
+
+        def allow(host):
+            breaker = self.breakers[host]
+            if breaker.given_up or not breaker.allow():
+                return False
+            requested[host] = breaker.state == "half-open"
+            return True
+
+        if self.redirects == "domain":
+            expanded_url, status, hops = await resolve_domain_url(self.session, url, self.host_limits, allow)
+            failed_host = url_host(hops[-1])  # the host of the hop that failed, e.g. bit.ly behind t.co
+        else:
+            failed_host = url_host(url)
+            if allow(failed_host):
+                async with self.host_limits[failed_host]:
+                    expanded_url, status, hops = await infer_base_url(self.session, url)
+            else:
+                expanded_url, status, hops = url, "CircuitOpen", [url]
+
+        if status == "CircuitOpen":
+            self._success(requested)  # the hops before the parked one answered (a probe among them closes its breaker)
+            self._park(url, attempt, failed_host)
+            return
+        if not is_retryable(status):
+            self._success(requested)
+            self._finish(url, expanded_url, status, hops)
+            return
+
+        self._success(host for host in requested if host != failed_host)
+        if self.breakers[failed_host].failure(requested.get(failed_host, False)):
+            self._trip(failed_host)
+        if attempt < self.max_retries:
+            self.retried.add(url)
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1)
+            asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, (url, attempt + 1))
+        else:
+            self._finish(url, expanded_url, status, hops)
+
+    def _park(self, url, attempt, host):
+        breaker = self.breakers[host]
+        if breaker.given_up:
+            self._finish(url, url, "CircuitOpen", [url])
+        elif breaker.state == "closed":  # closed meanwhile, e.g. by an earlier hop of this URL to the same host
+            self.queue.put_nowait((url, attempt))
+        else:
+            self.parked.add(url)
+            breaker.parked.append((url, attempt))
+
+    def _success(self, hosts):
+        for host in hosts:
+            for item in self.breakers[host].success():
+                self.queue.put_nowait(item)
+
+    def _trip(self, host):
+        breaker = self.breakers[host]
+        print("Parking {} after {} consecutive failed requests".format(host, breaker.failures))
+        if breaker.given_up:
+            released, breaker.parked = breaker.parked, []
+            for url, attempt in released:
+                self._finish(url, url, "CircuitOpen", [url])
+        else:
+            asyncio.get_running_loop().call_later(breaker.cooldown_time(), self._half_open, host)
+
+    def _half_open(self, host):
+        breaker = self.breakers[host]
+        if breaker.state != "open":
+            return  # the host recovered during the cooldown
+        breaker.state = "half-open"
+        if breaker.parked:
+            self.queue.put_nowait(breaker.parked.pop(0))
+
+    def _finish(self, url, expanded_url, status, hops):
+        if not is_expanded(status):
+            self.failed.add(url)
+        self.results.append((url, expanded_url, status, hops))
+        if self.on_result is not None:
+            self.on_result(url, expanded_url, status, hops)
+        if self.results.__len__() % 10000 == 0:
+            print("Expanded {} URLs".format(self.results.__len__()))
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.done.set()
+
+
+async def _expand_all(urls, max_connections, max_per_host, timeout, stats, **scheduler_settings):
+    """Expand all `urls` with `max_connections` workers sharing one session."""
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_per_host, ttl_dns_cache=300)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        scheduler = ExpansionScheduler(session, max_per_host=max_per_host, **scheduler_settings)
+        results = await scheduler.run(list(urls), max_connections)
+    if stats is not None:
+        stats.update(scheduler.stats)
+    return results
+
+
+def expand_urls_async(urls, redirects=DEFAULT_REDIRECTS, max_connections=DEFAULT_MAX_CONNECTIONS,
+                      max_per_host=DEFAULT_MAX_PER_HOST, timeout=DEFAULT_TIMEOUT, rate_per_host=DEFAULT_RATE_PER_HOST,
+                      max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF, breaker_failures=DEFAULT_BREAKER_FAILURES,
+                      breaker_cooldown=DEFAULT_BREAKER_COOLDOWN, breaker_max_trips=DEFAULT_BREAKER_MAX_TRIPS,
+                      on_result=None, stats=None):
+    """Expand a list of short URLs.
+        - `redirects` is "domain" (stop at the first URL that is not a short link) or "final" (follow all redirects)
+        - `on_result(short_url, expanded_url, status, hops)` is called as soon as each URL is done
+        - The numbers of URLs retried, parked and failed are stored in the `stats` dict, if given
+        - Returns a list of (short_url, expanded_url, status, hops) tuples, in order of completion
+    """
+    return asyncio.run(_expand_all(
+        urls, max_connections, max_per_host, timeout, stats, redirects=redirects, rate_per_host=rate_per_host,
+        max_retries=max_retries, backoff=backoff, breaker_failures=breaker_failures,
+        breaker_cooldown=breaker_cooldown, breaker_max_trips=breaker_max_trips, on_result=on_result,
+    ))
+
+
+def is_expanded(status):
+    """Whether an expansion with this status succeeded (an HTTP status below 400, or the urlexpander fallback)."""
+    return (status.isdigit() and int(status) < 400) or status == "urlexpander"
+
+
+class ExpansionCache:
+    """Durable cache of URL expansions: short_url -> expanded_url, its domain, status, redirect chain (`hops`, as a
+    json list of URLs) and time of the expansion.
+        - New expansions are written in batches as they come, so an interrupted run keeps what it did
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS expanded_urls (
+                short_url TEXT PRIMARY KEY,
+                expanded_url TEXT,
+                domain TEXT,
+                status TEXT,
+                expanded_at TEXT,
+                hops TEXT
+            )"""
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(expanded_urls)")]
+        if "hops" not in columns:  # cache created before the redirect chain was recorded
+            self.conn.execute("ALTER TABLE expanded_urls ADD COLUMN hops TEXT")
+        self.conn.commit()
+        self.pending = []
+
+    @classmethod
+    def from_config(cls, config):
+        """Open the cache stored in INTERMEDIATE_DATA_DIR."""
+        return cls(os.path.join(config["PATHS"]["INTERMEDIATE_DATA_DIR"], EXPANSION_CACHE_FILE))
+
+    def expanded_urls(self):
+        """Return the set of short URLs that were already expanded successfully (failed ones are retried)."""
+        rows = self.conn.execute("SELECT short_url, status FROM expanded_urls")
+        return {short_url for short_url, status in rows if is_expanded(status)}
+
+    def add(self, short_url, expanded_url, domain, status, hops=None):
+        """Record an expansion (replacing any previous one for `short_url`)."""
+        expanded_at = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+        hops = json.dumps(hops) if hops is not None else None
+        self.pending.append((short_url, expanded_url, domain, status, expanded_at, hops))
+        if self.pending.__len__() >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write pending expansions to disk."""
+        if self.pending:
+            self.conn.executemany("INSERT OR REPLACE INTO expanded_urls "
+                                  "(short_url, expanded_url, domain, status, expanded_at, hops) VALUES (?, ?, ?, ?, ?, ?)", self.pending)
+            self.conn.commit()
+            self.pending = []
+
+    def read(self):
+        """Return all expansions as a dataframe."""
+        self.flush()
+        return pd.read_sql_query("SELECT * FROM expanded_urls", self.conn)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -8,11 +8,25 @@ PURPOSE:
 import argparse
 import configparser
 import datetime
+import glob
+import gzip
+import io
+import json
 import logging
 import os
 
 import pandas as pd
 
+# Optional fast JSON parsers, from the fastest to the slowest; the standard `json` module is the fallback
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 class Geo:
     """A convenience class for geographic codes."""
 
@@ -139,7 +153,28 @@ def parse_cl_args():
             help="Use keywords filter",
             action='store_true'
         )
-            
+        parser.add_argument(
+            "-w", "--workers",
+            help="Number of worker processes used to process Twitter data files (default: 1)",
+            type=int,
+            default=1
+        )
+        parser.add_argument(
+            "-f", "--force",
+            help="Reprocess all input files (Twitter data files, daily tables), even those already recorded in the manifest",
+            action='store_true'
+        )
+        parser.add_argument(
+            "-d", "--daily",
+            help="Also write the US accounts tables of each day (from the creation time of tweets) in TABLES_DAILY_FOLDER",
+            action='store_true'
+        )
+        parser.add_argument(
+            "-r", "--relabel",
+            help="Only recompute low-credibility flags and the US accounts table from the (updated) LOW_CRED_FILE",
+            action='store_true'
+        )
+
         # Read parsed arguments from the command line into "args"
         args = parser.parse_args()
 
@@ -177,3 +212,146 @@ def convert_date_str_to_datetime(date):
     except Exception as e:
         print("Problem converting date to datetime object.")
         print(e)
+
+
+# Twitter data files contain one tweet json per line and can be compressed
+TWEET_FILE_PATTERNS = ["*json", "*json.gz", "*json.zst"]
+READ_BUFFER_SIZE = 16 * 1024 * 1024
+
+def list_tweet_files(folder):
+    """Return the sorted paths of all Twitter data files (`.json`, `.json.gz`, `.json.zst`) in `folder`."""
+    files = set()
+    for pattern in TWEET_FILE_PATTERNS:
+        files.update(glob.glob(os.path.join(folder, pattern)))
+    return sorted(files)
+
+def open_tweet_file(path):
+    """Open a Twitter data file for buffered binary reading, decompressing `.gz` and `.zst` files on the fly."""
+    if path.endswith(".gz"):
+        return io.BufferedReader(gzip.GzipFile(path, "rb"), buffer_size=READ_BUFFER_SIZE)
+    if path.endswith(".zst"):
+        # Optional dependency, only needed for zstandard-compressed files
+        import zstandard
+        raw = open(path, "rb")
+        reader = zstandard.ZstdDecompressor().stream_reader(raw, read_size=READ_BUFFER_SIZE, closefd=True)
+        return io.BufferedReader(reader, buffer_size=READ_BUFFER_SIZE)
+    return open(path, "rb", buffering=READ_BUFFER_SIZE)
+
+def iter_tweet_lines(path):
+    """Lazily yield the non-empty lines (as bytes) of a Twitter data file, so memory does not grow with file size."""
+    with open_tweet_file(path) as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+# Paths of the tweet json that are used by the pipeline (None marks a leaf that is kept as it is)
+_URL_ENTITIES = {"entities": {"urls": None}}
+TWEET_FIELDS = {
+    "id": None,
+    "id_str": None,
+    "created_at": None,
+    "text": None,
+    "entities": {"urls": None},
+    "extended_tweet": {"full_text": None, **_URL_ENTITIES},
+    "retweeted_status": {"text": None, **_URL_ENTITIES, "extended_tweet": {"full_text": None, **_URL_ENTITIES}},
+    "quoted_status": {"text": None, **_URL_ENTITIES, "extended_tweet": {"full_text": None, **_URL_ENTITIES}},
+    "user": {"id_str": None, "location": None, "time_zone": None},
+}
+
+if simdjson is not None:
+    _simdjson_parser = simdjson.Parser()
+    _JSON_OBJECT_TYPES = (dict, simdjson.Object)
+    _JSON_LAZY_TYPES = (simdjson.Object, simdjson.Array)
+else:
+    _JSON_OBJECT_TYPES = (dict,)
+    _JSON_LAZY_TYPES = ()
+
+def _project_fields(obj, fields):
+    """Return a dict with only the `fields` paths of `obj` (paths missing from `obj` are left out)."""
+    projected = {}
+    for key, subfields in fields.items():
+        if key not in obj:
+            continue
+        value = obj[key]
+        if subfields is None:
+            if isinstance(value, _JSON_LAZY_TYPES):
+                value = value.as_list() if isinstance(value, simdjson.Array) else value.as_dict()
+            projected[key] = value
+        elif isinstance(value, _JSON_OBJECT_TYPES):
+            projected[key] = _project_fields(value, subfields)
+    return projected
+
+def load_tweet(line, fields=TWEET_FIELDS):
+    """Parse one line of a Twitter data file, keeping only the `fields` paths of the tweet.
+
+    Uses `simdjson` (which only materializes the projected fields) or `orjson` when they are
+    installed, and the standard `json` module otherwise.
+    """
+    if simdjson is not None:
+        return _project_fields(_simdjson_parser.parse(line), fields)
+    if orjson is not None:
+        return _project_fields(orjson.loads(line), fields)
+    return _project_fields(json.loads(line), fields)
+
+_MONTHS = {month: "%02d" % (i + 1) for i, month in
+           enumerate(["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"])}
+
+def created_at_day(created_at):
+    """Return the (UTC) day of a tweet as YYYY-MM-DD, from its `created_at` field (e.g. "Wed Jan 06 00:00:01 +0000 2021")."""
+    if not created_at:
+        return None
+    return created_at[-4:] + "-" + _MONTHS[created_at[4:7]] + "-" + created_at[8:10]
+
+
+# Intermediate tables can be written as .csv (the default) or as .parquet (columnar, typed)
+TABLE_FORMATS = ["csv", "parquet"]
+
+def get_table_format(config):
+    """Return the format of intermediate tables set by INTERMEDIATE_FORMAT in the config file (default: csv)."""
+    table_format = config.get("DATA", "INTERMEDIATE_FORMAT", fallback="csv")
+    if table_format not in TABLE_FORMATS:
+        raise ValueError(f"INTERMEDIATE_FORMAT must be one of {TABLE_FORMATS}, not {table_format}")
+    return table_format
+
+def table_path(path, table_format):
+    """Return `path` with the file extension of `table_format`, e.g. tweet_url_table.csv -> tweet_url_table.parquet"""
+    return os.path.splitext(path)[0] + "." + table_format
+
+def write_table(df, path, table_format="csv", categorical=()):
+    """Write a dataframe as an intermediate table (`path` extension is set by `table_format`).
+        - With parquet, `categorical` string columns are dictionary-encoded
+    """
+    path = table_path(path, table_format)
+    if table_format == "parquet":
+        df = df.astype({col: "category" for col in categorical})
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+def load_manifest(manifest_path):
+    """Load a json manifest of processed input files (empty if it does not exist yet)."""
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_path):
+    """Save a json manifest atomically, so that a crash never leaves it half written."""
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+def read_table(path, table_format="csv", dtype=None, columns=None, na_values=None):
+    """Read an intermediate table written by `write_table`.
+        - `dtype` is only needed for csv tables, parquet tables keep the types they were written with
+        - `na_values`: if given, only these strings are missing values of csv tables (instead of the defaults of
+          pandas, which include "None" and "NA")
+    """
+    path = table_path(path, table_format)
+    if table_format == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    if na_values is not None:
+        return pd.read_csv(path, dtype=dtype, usecols=columns, keep_default_na=False, na_values=na_values)
+    return pd.read_csv(path, dtype=dtype, usecols=columns)